@@ -1,5 +1,6 @@
 import fastapi
 from .sensors.controller import router as sensorsRouter
+from shared.timescale import get_pool
 
 app = fastapi.FastAPI(title="Senser", version="0.1.0-alpha.1")
 
@@ -9,3 +10,9 @@ app.include_router(sensorsRouter)
 def index():
     #Return the api name and version
     return {"name": app.title, "version": app.version}
+
+
+@app.get("/stats/timescale_pool")
+def timescale_pool_stats():
+    #Return the usage of the Timescale connection pool
+    return get_pool().stats()
@@ -1,14 +1,22 @@
+import itertools
 import json
+from datetime import datetime, timedelta
+from typing import Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from shared.database import SessionLocal
-from shared.publisher import Publisher
+from shared.publisher import PublisherPool
+from shared.async_publisher import AsyncPublisher
+from shared.codec import MsgpackCodec
 from shared.redis_client import RedisClient
 from shared.mongodb_client import MongoDBClient
 from shared.elasticsearch_client import ElasticsearchClient
-from shared.timescale import Timescale
+from shared.bucket_cache import BucketCache
+from shared.downsampling import METHODS
+from shared.timescale import Timescale, get_pool
 from shared.sensors import repository, schemas
 from shared.cassandra_client import CassandraClient
 
@@ -18,6 +26,12 @@ router = APIRouter(
     tags=["sensors"],
 )
 
+# Upper bound of the ids of GET /sensors/data, every id is one IN/ANY element
+MAX_SENSORS_PER_REQUEST = 100
+
+# Upper bound of the range of GET /sensors/{sensor_id}/readings, every day is one Cassandra partition read
+MAX_READINGS_DAYS = 31
+
 
 def get_db():
     db = SessionLocal()
@@ -28,12 +42,31 @@ def get_db():
 
 
 def get_timescale():
-    ts = Timescale()
+    # Borrow a connection from the process-wide pool instead of connecting on every request
+    ts = Timescale(pool=get_pool())
     try:
         yield ts
     finally:
         ts.close()
 
+
+# Downsampling of the time-series endpoints: ?max_points=<n>&downsample=lttb|min_max
+def get_downsampling(request: Request):
+    max_points = request.query_params.get('max_points', None)
+    method = request.query_params.get('downsample', 'lttb')
+    if method not in METHODS:
+        raise HTTPException(status_code=400, detail=f"downsample must be one of {', '.join(METHODS)}")
+    if max_points is None:
+        return None, method
+    try:
+        max_points = int(max_points)
+    except ValueError:
+        max_points = 0
+    if max_points < 3:
+        raise HTTPException(status_code=400, detail="max_points must be an integer of at least 3")
+    return max_points, method
+
+
 # Dependency to get redis client
 
 
@@ -68,14 +101,33 @@ def get_elastic_search():
 
 
 def get_cassandra_client():
-    cassandra = CassandraClient(hosts=["cassandra"])
-    try:
-        yield cassandra
-    finally:
-        cassandra.close()
+    # Process-wide session, it keeps the connections and prepared statements across requests
+    return CassandraClient.instance(hosts=["cassandra"])
+
+
+# One publisher shared by the threadpool, readings of concurrent requests are sent in bursts
+# of up to 100 messages or 5 ms and every request waits only for the confirm of its own reading.
+publisher_pool = PublisherPool(confirm_delivery=True, batch_size=100, batch_latency=0.005, codec=MsgpackCodec())
+
+
+# Publisher shared by the async endpoints, it lives on the event loop
+async_publisher = AsyncPublisher(codec=MsgpackCodec())
+
 
+async def get_async_publisher():
+    await async_publisher.ensure_connected()
+    return async_publisher
 
-publisher = Publisher()
+
+@router.on_event("shutdown")
+async def close_publishers():
+    publisher_pool.close()
+    await async_publisher.close()
+
+
+@router.on_event("shutdown")
+def close_cassandra():
+    CassandraClient.close_instance()
 
 
 @router.get("/near")
@@ -111,9 +163,45 @@ def get_sensors_quantity(cassandra_client: CassandraClient = Depends(get_cassand
 
 
 @router.get("/low_battery")
-def get_low_battery_sensors(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client), mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
-    # raise HTTPException(status_code=404, detail="Not implemented")
-    return repository.get_low_battery_sensors(db=db, cassandra=cassandra_client, mongodb=mongodb_client)
+def get_low_battery_sensors(threshold: float = 0.2, db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client), mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="threshold must be in (0, 1]")
+    return repository.get_low_battery_sensors(db=db, cassandra=cassandra_client, mongodb=mongodb_client, threshold=threshold)
+
+
+# Declared before the /{sensor_id} routes, which would otherwise match /latest
+@router.get("/latest")
+def get_latest(ids: Optional[str] = None, redis: RedisClient = Depends(get_redis_client)):
+    sensor_ids = None
+    if ids is not None:
+        try:
+            sensor_ids = [int(sensor_id) for sensor_id in ids.split(",") if sensor_id.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ids must be a comma separated list of sensor ids")
+    return repository.get_latest(redis=redis, sensor_ids=sensor_ids)
+
+
+# Declared before the /{sensor_id} routes, which would otherwise match /data
+@router.get("/data")
+def get_data_many(ids: str, request: Request, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), timescale: Timescale = Depends(get_timescale), downsampling: tuple = Depends(get_downsampling)):
+    try:
+        sensor_ids = list(dict.fromkeys(int(sensor_id) for sensor_id in ids.split(",") if sensor_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of sensor ids")
+    if not sensor_ids:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of sensor ids")
+    if len(sensor_ids) > MAX_SENSORS_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SENSORS_PER_REQUEST} sensors per request")
+
+    return repository.get_data_many(db=db,
+                                    mongo_db=mongodb_client,
+                                    timescale=timescale,
+                                    sensor_ids=sensor_ids,
+                                    from_date=request.query_params.get('from', None),
+                                    to_date=request.query_params.get('to', None),
+                                    bucket_size=request.query_params.get('bucket', None),
+                                    max_points=downsampling[0],
+                                    method=downsampling[1])
 
 
 @router.get("")
@@ -128,7 +216,7 @@ def create_sensor(sensor: schemas.SensorCreate, db: Session = Depends(get_db), m
     if db_sensor:
         raise HTTPException(
             status_code=400, detail="Sensor with same name already registered")
-    return repository.create_sensor(db, sensor, mongodb_client, elastic, publisher)
+    return repository.create_sensor(db, sensor, mongodb_client, elastic, publisher_pool.get())
 
 
 # 🙋🏽‍♀️ Add here the route to get a sensor by id
@@ -149,7 +237,8 @@ def delete_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client:
     return repository.delete_sensor(db=db,
                                     mongo_db=mongodb_client,
                                     redis=redis,
-                                    sensor_id=sensor_id)
+                                    sensor_id=sensor_id,
+                                    publisher=publisher_pool.get())
 
 # 🙋🏽‍♀️ Add here the route to update a sensor
 
@@ -162,24 +251,76 @@ def record_data(sensor_id: int, data: schemas.SensorData, db: Session = Depends(
                                   mongo_db=mongodb_client,
                                   sensor_id=sensor_id,
                                   data=data,
-                                  publisher=publisher)
+                                  publisher=publisher_pool.get())
+
+
+@router.post("/{sensor_id}/data/async")
+async def record_data_async(sensor_id: int, data: schemas.SensorData, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), publisher: AsyncPublisher = Depends(get_async_publisher)):
+    return await repository.record_data_async(db=db,
+                                              mongo_db=mongodb_client,
+                                              sensor_id=sensor_id,
+                                              data=data,
+                                              publisher=publisher)
 
 
 #
 @router.get("/{sensor_id}/data")
-def get_data(sensor_id: int, request: Request, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), timescale: Timescale = Depends(get_timescale)):
+def get_data(sensor_id: int, request: Request, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), timescale: Timescale = Depends(get_timescale), redis: RedisClient = Depends(get_redis_client), downsampling: tuple = Depends(get_downsampling)):
     # Extract query parameters from the request
     from_date = request.query_params.get('from', None)
     to_date = request.query_params.get('to', None)
     bucket_size = request.query_params.get('bucket', None)
 
+    # ?format=ndjson streams the buckets from a server-side cursor instead of building the whole list,
+    # it is never downsampled since that needs the whole series
+    if request.query_params.get('format') == 'ndjson':
+        lines = repository.stream_data(db=db,
+                                       mongo_db=mongodb_client,
+                                       timescale=timescale,
+                                       sensor_id=sensor_id,
+                                       from_date=from_date,
+                                       to_date=to_date,
+                                       bucket_size=bucket_size)
+        # Pull the first line so a missing sensor is still answered with a 404
+        try:
+            first = next(lines)
+        except StopIteration:
+            first = ""
+        return StreamingResponse(itertools.chain([first], lines), media_type="application/x-ndjson")
+
     return repository.get_data(db=db,
                                mongo_db=mongodb_client,
                                timescale=timescale,
                                sensor_id=sensor_id,
                                from_date=from_date,
                                to_date=to_date,
-                               bucket_size=bucket_size)
+                               bucket_size=bucket_size,
+                               cache=BucketCache(redis),
+                               max_points=downsampling[0],
+                               method=downsampling[1])
+
+
+# Raw readings, read from the Cassandra day partitions the range covers
+@router.get("/{sensor_id}/readings")
+def get_readings(sensor_id: int, request: Request, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
+    try:
+        from_date = datetime.fromisoformat(request.query_params['from'])
+        to_date = datetime.fromisoformat(request.query_params['to'])
+        span = to_date - from_date
+    except (KeyError, ValueError, TypeError):
+        # TypeError: one of them has a time zone and the other one not
+        raise HTTPException(status_code=400, detail="from and to must be ISO 8601 timestamps")
+    if span < timedelta(0):
+        raise HTTPException(status_code=400, detail="from must not be after to")
+    if span > timedelta(days=MAX_READINGS_DAYS):
+        raise HTTPException(status_code=400, detail=f"At most {MAX_READINGS_DAYS} days per request")
+
+    return repository.get_readings(db=db,
+                                   mongo_db=mongodb_client,
+                                   cassandra=cassandra_client,
+                                   sensor_id=sensor_id,
+                                   from_date=from_date,
+                                   to_date=to_date)
 
 
 class ExamplePayload():
@@ -193,12 +334,12 @@ class ExamplePayload():
 @router.post("/exemple/queue")
 def exemple_queue():
     # Publish here the data to the queue
-    publisher.publish_to('test', ExamplePayload("holaaaaa"))
+    publisher_pool.get().publish_to('test', ExamplePayload("holaaaaa"))
     return {"message": "Data published to the queue"}
 
 
 @router.post("/exemple/queue2")
 def exemple_queue():
     # Publish here the data to the queue
-    publisher.publish_to('redis', ExamplePayload("holaaaaa2"))
+    publisher_pool.get().publish_to('redis', ExamplePayload("holaaaaa2"))
     return {"message": "Data published to the queue"}
@@ -37,6 +37,7 @@ def clear_dbs():
         try:
             cassandra = CassandraClient(["cassandra"])
             cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
+            cassandra.create_schema()
             cassandra.close()
             break
         except Exception as e:
@@ -0,0 +1,28 @@
+import pytest
+from shared.codec import CODEC_VERSION, JsonCodec, MsgpackCodec, get_codec
+from shared.message import MessageStrcuture
+
+message = MessageStrcuture("reading", {"sensor_id": 1, "sensor_type": "Temperatura", "temperature": 1.0,
+                                       "humidity": None, "battery_level": 0.5, "last_seen": "2020-01-01T00:00:00.000Z"})
+
+
+@pytest.mark.parametrize("codec", [JsonCodec(), MsgpackCodec()])
+def test_codec_round_trip(codec):
+    body = message.encode(codec)
+    assert get_codec(codec.content_type).decode(body) == message.to_dict()
+
+
+def test_msgpack_codec_rejects_unknown_version():
+    body = message.encode(MsgpackCodec())
+    with pytest.raises(ValueError):
+        MsgpackCodec().decode(bytes([CODEC_VERSION + 1]) + body[1:])
+
+
+def test_get_codec_defaults_to_json():
+    assert isinstance(get_codec(None), JsonCodec)
+    assert get_codec(None).decode(message.encode(JsonCodec())) == message.to_dict()
+
+
+def test_get_codec_unknown_content_type():
+    with pytest.raises(ValueError):
+        get_codec("text/plain")
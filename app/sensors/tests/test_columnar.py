@@ -37,6 +37,7 @@ def clear_dbs():
         try:
             cassandra = CassandraClient(["cassandra"])
             cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
+            cassandra.create_schema()
             cassandra.close()
             break
         except Exception as e:
@@ -166,6 +167,17 @@ def test_get_values_sensor_temperatura():
     }
 
 
+def test_reconcile_temperature_stats():
+    """The statistics kept at ingest match the ones recomputed from the stored readings"""
+    cassandra = CassandraClient(["cassandra"])
+    try:
+        before = cassandra.get_temperature_values()
+        assert cassandra.reconcile_temperature_stats() == 0
+        assert cassandra.get_temperature_values() == before
+    finally:
+        cassandra.close()
+
+
 def test_get_sensors_quantity():
     response = client.get("/sensors/quantity_by_type")
     assert response.status_code == 200
@@ -179,4 +191,51 @@ def test_get_sensors_low_battery():
     assert response.json() == {"sensors": [
         {"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1", "battery_level": 0.1}, 
         {"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2", "battery_level": 0.15}
-    ]}
\ No newline at end of file
+    ]}
+
+
+def test_get_sensors_low_battery_threshold():
+    response = client.get("/sensors/low_battery?threshold=0.12")
+    assert response.status_code == 200
+    assert [sensor["id"] for sensor in response.json()["sensors"]] == [2]
+
+
+def test_backfill_battery_bands():
+    """A level written before the band column gets its band row from the backfill"""
+    cassandra = CassandraClient(["cassandra"])
+    try:
+        cassandra.execute("INSERT INTO sensor.sensor_battery_level (sensor_id, battery_level) VALUES (99, 0.05)")
+        assert 99 not in [sensor["sensor_id"] for sensor in cassandra.get_sensor_low_battery()]
+        cassandra.backfill_battery_bands()
+        assert [sensor["sensor_id"] for sensor in cassandra.get_sensor_low_battery()] == [2, 3, 99]
+        assert cassandra.execute("SELECT band FROM sensor.sensor_battery_level WHERE sensor_id = 99").one().band == 0
+    finally:
+        cassandra.execute("DELETE FROM sensor.sensor_battery_level WHERE sensor_id = 99")
+        cassandra.execute("DELETE FROM sensor.sensor_battery_band WHERE band = 0 AND sensor_id = 99")
+        cassandra.close()
+
+
+def test_get_data_range_across_days():
+    """Readings on both sides of midnight are read back from their two day partitions, newest first"""
+    cassandra = CassandraClient(["cassandra"])
+    try:
+        cassandra.insert_data(98, "2021-03-01T23:59:00+00:00", "Temperatura", temperature=1.0)
+        cassandra.insert_data(98, "2021-03-02T00:01:00+00:00", "Temperatura", temperature=2.0)
+        cassandra.insert_data(98, "2021-03-02T12:00:00+00:00", "Temperatura", temperature=3.0)
+        readings = cassandra.get_data_range(98, "2021-03-01T00:00:00+00:00", "2021-03-02T00:01:00+00:00")
+        assert [reading["temperature"] for reading in readings] == [2.0, 1.0]
+        assert readings[0]["last_seen"] > readings[1]["last_seen"]
+    finally:
+        cassandra.delete_sensor_data(98)
+        cassandra.close()
+
+
+def test_get_sensor_readings():
+    response = client.get("/sensors/1/readings?from=2019-12-31T00:00:00.000Z&to=2020-01-02T00:00:00.000Z")
+    assert response.status_code == 200
+    assert [reading["temperature"] for reading in response.json()] == [4.0, 1.0]
+
+
+def test_get_sensor_readings_range_too_long():
+    response = client.get("/sensors/1/readings?from=2020-01-01T00:00:00.000Z&to=2020-03-01T00:00:00.000Z")
+    assert response.status_code == 400
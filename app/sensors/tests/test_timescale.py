@@ -37,6 +37,7 @@ def clear_dbs():
         try:
             cassandra = CassandraClient(["cassandra"])
             cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
+            cassandra.create_schema()
             cassandra.close()
             break
         except Exception as e:
@@ -114,6 +115,36 @@ def test_get_sensor_data_1_day():
     json = response.json()
     assert len(json) == 3
 
+def test_get_sensor_data_1_day_cached():
+    """The second request is served from the bucket cache and returns the same buckets"""
+    url = "/sensors/1/data?from=2020-01-01T00:00:00.000Z&to=2020-01-03T00:00:00.000Z&bucket=day"
+    first = client.get(url)
+    second = client.get(url)
+    assert second.status_code == 200
+    assert second.json() == first.json()
+
+@pytest.fixture
+def hourly_series():
+    """24 hourly readings of sensor 1 on 2018-06-01, the temperature is the hour"""
+    ts = Timescale()
+    readings = [{"sensor_id": 1, "temperature": float(hour), "humidity": 1.0, "battery_level": 1.0, "last_seen": f"2018-06-01T{hour:02d}:00:00.000Z"} for hour in range(24)]
+    ts.copy_readings(readings)
+    ts.close()
+
+def test_get_sensor_data_1_day_downsampled(hourly_series):
+    response = client.get("/sensors/1/data?from=2018-06-01T00:00:00.000Z&to=2018-06-01T23:00:00.000Z&bucket=hour&max_points=5")
+    assert response.status_code == 200
+    json = response.json()
+    assert len(json) == 5
+    assert json[0][1] == 0.0 and json[-1][1] == 23.0
+
+def test_get_sensor_data_1_day_ndjson():
+    response = client.get("/sensors/1/data?from=2020-01-01T00:00:00.000Z&to=2020-01-03T00:00:00.000Z&bucket=day&format=ndjson")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert len(lines) == 3
+
 def test_get_sensor_data_1_week():
     response = client.get("/sensors/1/data?from=2020-01-01T00:00:00.000Z&to=2020-01-07T00:00:00.000Z&bucket=week")
     assert response.status_code == 200
@@ -144,6 +175,30 @@ def test_get_sensor_data_3_month():
     json = response.json()
     assert len(json) == 1
     
+def test_get_sensor_data_many():
+    response = client.get("/sensors/data?ids=1,2&from=2020-01-01T00:00:00.000Z&to=2020-01-02T00:00:00.000Z&bucket=day")
+    assert response.status_code == 200
+    json = response.json()
+    assert len(json["1"]) == 2
+    assert len(json["2"]) == 1
+
+def test_get_sensor_data_many_not_exists():
+    response = client.get("/sensors/data?ids=1,4&from=2020-01-01T00:00:00.000Z&to=2020-01-02T00:00:00.000Z&bucket=day")
+    assert response.status_code == 404
+    assert "Sensor not found" in response.text
+
+def test_get_sensors_latest():
+    response = client.get("/sensors/latest?ids=1,2")
+    assert response.status_code == 200
+    json = response.json()
+    assert json["1"]["last_seen"] == "2020-01-03T00:00:00.000Z"
+    assert json["1"]["temperature"] == 18.0
+
+def test_get_sensors_latest_empty_ids():
+    response = client.get("/sensors/latest?ids=")
+    assert response.status_code == 200
+    assert response.json() == {}
+
 def test_post_sensor_data_not_exists():
     response = client.post("/sensors/4/data", json={"temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
     assert response.status_code == 404
@@ -152,4 +207,38 @@ def test_post_sensor_data_not_exists():
 def test_get_sensor_data_not_exists():
     response = client.get("/sensors/4/data")
     assert response.status_code == 404
-    assert "Sensor not found" in response.text
\ No newline at end of file
+    assert "Sensor not found" in response.text
+
+def test_post_sensor_data_async():
+    response = client.post("/sensors/1/data/async", json={"temperature": 20.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-04T00:00:00.000Z"})
+    assert response.status_code == 200
+    assert response.json() == {"velocity": None, "temperature": 20.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-04T00:00:00.000Z"}
+
+def test_post_sensor_data_async_not_exists():
+    response = client.post("/sensors/4/data/async", json={"temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
+    assert response.status_code == 404
+    assert "Sensor not found" in response.text
+
+def test_copy_readings():
+    ts = Timescale()
+    readings = [{"sensor_id": 100, "temperature": float(hour), "humidity": 1.0, "battery_level": 1.0, "last_seen": f"2019-01-01T{hour:02d}:00:00.000Z"} for hour in range(24)]
+    stats = ts.copy_readings(iter(readings), chunk_size=10)
+    assert [chunk["rows"] for chunk in stats] == [10, 10, 4]
+    # Running the backfill again skips the readings that are already stored
+    stats = ts.copy_readings(readings, chunk_size=10)
+    assert [chunk["inserted"] for chunk in stats] == [0, 0, 0]
+    assert len(ts.get_data(100, from_date="2019-01-01T00:00:00.000Z", to_date="2019-01-01T23:00:00.000Z", bucket_size="hour")) == 24
+    ts.close()
+
+@pytest.mark.parametrize("method", ["lttb", "min_max"])
+def test_get_data_downsampled(hourly_series, method):
+    """The 24 hourly buckets are downsampled to 5 points"""
+    ts = Timescale()
+    data = ts.get_data(1, from_date="2018-06-01T00:00:00.000Z", to_date="2018-06-01T23:00:00.000Z", bucket_size="hour", max_points=5, method=method)
+    ts.close()
+    buckets = [row[0] for row in data]
+    # LTTB keeps exactly max_points, min/max the min and max of max_points // 2 bins
+    assert len(data) == (5 if method == "lttb" else 4)
+    assert data[0][1] == 0.0 and data[-1][1] == 23.0
+    assert buckets[0].hour == 0 and buckets[-1].hour == 23
+    assert buckets == sorted(buckets)
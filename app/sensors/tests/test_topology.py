@@ -0,0 +1,13 @@
+from shared.topology import READINGS_EXCHANGE, operations
+
+
+def test_readings_exchange_binds_every_sink_queue():
+    calls = operations(READINGS_EXCHANGE)
+    assert calls[0] == ('exchange_declare', {'exchange': READINGS_EXCHANGE, 'exchange_type': 'fanout'})
+    for queue in ('redis', 'ts', 'cassandra'):
+        assert ('queue_declare', {'queue': queue}) in calls
+        assert ('queue_bind', {'queue': queue, 'exchange': READINGS_EXCHANGE}) in calls
+
+
+def test_default_exchange_declares_only_the_queue():
+    assert operations(routing_key='test') == [('queue_declare', {'queue': 'test'})]
@@ -0,0 +1,43 @@
+"""
+Microbenchmark of the wire codecs in shared/codec.py.
+
+Encodes and decodes the messages that `record_data` publishes for one reading and
+reports the bytes per message and the encode/decode throughput of each codec.
+
+Usage:
+    python benchmarks/codec_benchmark.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from shared.codec import JsonCodec, MsgpackCodec
+from shared.message import MessageStrcuture
+
+MESSAGES = [
+    MessageStrcuture("set_data", {"sensor_id": 1, "data": {"velocity": None, "temperature": 18.5, "humidity": 0.4, "battery_level": 0.9, "last_seen": "2020-01-01T00:00:00.000Z"}}),
+    MessageStrcuture("insert_data", {"sensor_id": 1, "velocity": None, "temperature": 18.5, "humidity": 0.4, "battery_level": 0.9, "last_seen": "2020-01-01T00:00:00.000Z"}),
+    MessageStrcuture("insert_data", {"sensor_id": 1, "last_seen": "2020-01-01T00:00:00.000Z", "sensor_type": "Temperatura", "temperature": 18.5, "velocity": None}),
+    MessageStrcuture("insert_battery_level", {"sensor_id": 1, "battery_level": 0.9}),
+]
+
+
+def bench(name, encode, decode, iterations):
+    bodies = [encode(message) for message in MESSAGES]
+    size = sum(len(body) for body in bodies) / len(bodies)
+    encode_time = timeit.timeit(lambda: [encode(message) for message in MESSAGES], number=iterations)
+    decode_time = timeit.timeit(lambda: [decode(body) for body in bodies], number=iterations)
+    total = iterations * len(MESSAGES)
+    print(f"{name:<22} {size:>8.1f} B/msg {total / encode_time:>12,.0f} enc/s {total / decode_time:>12,.0f} dec/s")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    json_codec = JsonCodec()
+    msgpack_codec = MsgpackCodec()
+
+    # The format the publisher used before the codec layer
+    bench("legacy to_json", lambda m: m.to_json().encode("utf-8"), json_codec.decode, iterations)
+    bench(json_codec.content_type, lambda m: m.encode(json_codec), json_codec.decode, iterations)
+    bench(msgpack_codec.content_type, lambda m: m.encode(msgpack_codec), msgpack_codec.decode, iterations)
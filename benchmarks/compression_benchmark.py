@@ -0,0 +1,102 @@
+"""
+Disk footprint and scan time of sensor readings before and after native compression.
+
+Creates a scratch hypertable shaped like sensor_data, with the chunk interval and the
+compression settings of migrations_ts, seeds one reading per minute for a few sensors and
+measures its size and the time of the raw `get_data` scan with every chunk uncompressed and
+compressed. The scratch table is dropped afterwards, sensor_data is never touched.
+Needs the migrations in migrations_ts applied and the TS_* environment variables set.
+
+Usage:
+    python benchmarks/compression_benchmark.py [days] [sensors]
+"""
+import csv
+import io
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from shared.timescale import Timescale
+
+TABLE = "sensor_data_compression_benchmark"
+
+# The raw path of Timescale.get_data, the continuous aggregates would hide the scan
+SCAN = (
+    "SELECT time_bucket('1 hour', time) AS bucket, AVG(temperature), AVG(humidity), AVG(battery_level), AVG(velocity) "
+    f"FROM {TABLE} WHERE sensor_id = %s AND time >= %s AND time <= %s GROUP BY bucket ORDER BY bucket ASC"
+)
+
+
+def create_table(timescale):
+    # Same columns, chunks and compression settings as sensor_data, see migrations_ts
+    timescale.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    timescale.execute(f"CREATE TABLE {TABLE} (LIKE sensor_data INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES)")
+    timescale.execute(f"SELECT create_hypertable('{TABLE}', 'time', chunk_time_interval => INTERVAL '1 day')")
+    timescale.execute(
+        f"ALTER TABLE {TABLE} SET (timescaledb.compress, timescaledb.compress_segmentby = 'sensor_id', "
+        "timescaledb.compress_orderby = 'time DESC')"
+    )
+    timescale.conn.commit()
+
+
+def drop_table(timescale):
+    timescale.conn.rollback()
+    timescale.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    timescale.conn.commit()
+
+
+def seed(timescale, start, days, sensors):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for minute in range(days * 24 * 60):
+        last_seen = (start + timedelta(minutes=minute)).isoformat()
+        for sensor_id in range(1, sensors + 1):
+            # None is written as an empty unquoted field, which COPY reads as NULL
+            writer.writerow((sensor_id, 20 + (minute % 600) / 100, 0.5, 1 - minute / (days * 24 * 60), None, last_seen))
+    buffer.seek(0)
+    began = time.perf_counter()
+    timescale.cursor.copy_expert(
+        f"COPY {TABLE} (sensor_id, temperature, humidity, battery_level, velocity, time) FROM STDIN WITH (FORMAT csv)",
+        buffer
+    )
+    timescale.conn.commit()
+    print(f"seeded {days * 24 * 60 * sensors:,} readings in {time.perf_counter() - began:.1f} s")
+
+
+def measure(timescale, label, start, days, repeat=5):
+    cursor = timescale.getCursor()
+    cursor.execute("SELECT hypertable_size(%s)", (TABLE,))
+    size = cursor.fetchone()[0]
+    params = (1, start, start + timedelta(days=days))
+    began = time.perf_counter()
+    for _ in range(repeat):
+        cursor.execute(SCAN, params)
+        rows = cursor.fetchall()
+    scan = (time.perf_counter() - began) / repeat
+    timescale.conn.rollback()
+    print(f"{label:<14} {size / 2 ** 20:>10.1f} MiB {scan * 1000:>10.1f} ms/scan {len(rows):>8} buckets")
+    return size
+
+
+def compress(timescale):
+    timescale.execute(f"SELECT compress_chunk(c) FROM show_chunks('{TABLE}') c")
+    timescale.conn.commit()
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    timescale = Timescale()
+    try:
+        create_table(timescale)
+        seed(timescale, start, days, sensors)
+        before = measure(timescale, "uncompressed", start, days)
+        compress(timescale)
+        after = measure(timescale, "compressed", start, days)
+        print(f"compression ratio {before / after:.1f}x")
+    finally:
+        drop_table(timescale)
+        timescale.close()
@@ -1,60 +1,80 @@
-import json
 import os
 import sys
 import logging
-from fastapi import Depends
+from cassandra import OperationTimedOut
+from cassandra.cluster import NoHostAvailable
+from cassandra.connection import ConnectionException
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from shared.subscriber import Subscriber
 from shared.cassandra_client import CassandraClient
 
 class CassandraConsumer(Subscriber):
+    connection_errors = (NoHostAvailable, OperationTimedOut, ConnectionException)
+
     def __init__(self, config):
         super().__init__(config)
+        # Requests in flight at once when a batch is written
+        self.concurrency = config.get('concurrency', 32)
 
-    def consume(self):
-        def callback(ch, method, properties, body):
-            database = CassandraClient(hosts=["cassandra"])
-            message = json.loads(body)
-            action = message.get("action")
-            data = message.get("data")
-            logging.info(f"Cassandra: Received message of action: {action}")
-            logging.info(f"Cassandra: Data: {data}")
+    def connect_sink(self):
+        # The schema is created by the migration step, python -m shared.cassandra_client
+        return CassandraClient.instance(hosts=["cassandra"])
 
+    def handle_batch(self, messages):
+        database = self.get_sink()
+        writes = []
+        temperatures = []
+        # Latest battery level of each sensor, its band move is computed once per batch
+        levels = {}
+        # Registered with lightweight transactions, which can not be batched with the other writes
+        sensors = []
+        # Sensors deleted by this batch, the statistics of their later readings are dropped
+        deleted = set()
+        for action, data in messages:
             if action == "insert_sensor_type":
-                database.insert_sensor_type(
-                    sensor_id=data.get("sensor_id"),
-                    sensor_type=data.get("sensor_type"),
-                )
-            elif action == "insert_data":
-                database.insert_data(
+                sensors.append((data.get("sensor_id"), data.get("sensor_type")))
+            elif action in ("insert_data", "reading"):
+                writes.extend(database.data_writes(
                     sensor_id=data.get("sensor_id"),
                     last_seen=data.get("last_seen"),
                     sensor_type=data.get("sensor_type"),
                     temperature=data.get("temperature"),
                     velocity=data.get("velocity"),
-                )
+                ))
+                if data.get("sensor_id") not in deleted:
+                    temperatures.append((data.get("sensor_type"), data.get("sensor_id"), data.get("last_seen"), data.get("temperature")))
+                if action == "reading" and data.get("battery_level") is not None:
+                    levels[data.get("sensor_id")] = data.get("battery_level")
             elif action == "insert_battery_level":
-                database.insert_battery_level(
-                    sensor_id=data.get("sensor_id"),
-                    battery_level=data.get("battery_level")
-                )
+                if data.get("battery_level") is not None:
+                    levels[data.get("sensor_id")] = data.get("battery_level")
             elif action == "delete":
+                # A delete must not share a timestamp with the writes around it, the writes before
+                # it are sent first and the delete on its own
+                writes.extend(database.battery_band_writes(levels, concurrency=self.concurrency))
+                database.execute_writes(writes, concurrency=self.concurrency)
+                database.register_sensor_types(sensors, concurrency=self.concurrency)
+                # Counted before the delete, or they would recreate the statistics it drops
+                database.update_temperature_stats(temperatures, concurrency=self.concurrency)
+                writes = []
+                levels = {}
+                sensors = []
+                temperatures = []
+                deleted.add(data.get("sensor_id"))
                 database.delete_sensor_data(
                     sensor_id=data.get("sensor_id"),
                 )
+                if data.get("sensor_type") is not None:
+                    database.unregister_sensor_type(data.get("sensor_id"), data.get("sensor_type"))
             else:
                 logging.error(f"Cassandra: Action {action} not supported")
-            
-            database.close()
 
-            
-        try:
-            self.channel.basic_consume(queue=self.queue_name, on_message_callback=callback, auto_ack=True)
-            logging.info("Cassandra: Started consuming messages")
-            self.channel.start_consuming()
-        except Exception as e:
-            logging.error(f"Error during consumption: {e}")
-            raise e
-        
+        writes.extend(database.battery_band_writes(levels, concurrency=self.concurrency))
+        requests = database.execute_writes(writes, concurrency=self.concurrency)
+        database.register_sensor_types(sensors, concurrency=self.concurrency)
+        # Counted once the readings are stored, a batch that fails before this point counts nothing
+        database.update_temperature_stats(temperatures, concurrency=self.concurrency)
+        logging.info(f"Cassandra: Wrote a batch of {len(messages)} messages in {requests} requests")
+
     def close(self):
-        super().close()    
\ No newline at end of file
+        super().close()    
@@ -2,43 +2,54 @@ import json
 import os
 import sys
 import logging
+import redis
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from shared.subscriber import Subscriber
 from shared.redis_client import RedisClient
-from shared.message import MessageStrcuture
+from shared.latest_readings import LatestReadings
 
 class RedisConsumer(Subscriber):
+    connection_errors = (redis.ConnectionError, redis.TimeoutError)
+
     def __init__(self, config):
         super().__init__(config)
 
-    def consume(self):
-        def callback(ch, method, properties, body: MessageStrcuture):
-            database = RedisClient(host="redis")
-            message = json.loads(body)
-            action = message.get("action")
-            data = message.get("data")
+    def connect_sink(self):
+        return RedisClient(host="redis")
 
-            logging.info(f"Redis: Received message of action: {action}")
-            logging.info(f"Redis: Data: {data}, type: {type(data)}")
+    def handle(self, action, data):
+        database = self.get_sink()
 
-            if action == "set_data":
-                logging.info(f"Redis: Setting data {data.get('data')} with key {data.get('sensor_id')}")
-                database.set(
-                    key=str(data.get("sensor_id")),
-                    value=json.dumps(data.get("data"))
-                )
-            else:
-                logging.error(f"Redis: Action {action} not supported")
-            database.close()
+        logging.info(f"Redis: Received message of action: {action}")
+        logging.info(f"Redis: Data: {data}, type: {type(data)}")
 
-        try:
-            self.channel.basic_consume(queue=self.queue_name, on_message_callback=callback, auto_ack=True)
-            logging.info("Redis: Started consuming messages")
-            self.channel.start_consuming()
-        except Exception as e:
-            logging.error(f"Error during consumption: {e}")
-            raise e
+        if action == "set_data":
+            logging.info(f"Redis: Setting data {data.get('data')} with key {data.get('sensor_id')}")
+            database.set(
+                key=str(data.get("sensor_id")),
+                value=json.dumps(data.get("data"))
+            )
+        elif action == "reading":
+            # Redis keeps the latest reading of each sensor
+            reading = {
+                "velocity": data.get("velocity"),
+                "temperature": data.get("temperature"),
+                "humidity": data.get("humidity"),
+                "battery_level": data.get("battery_level"),
+                "last_seen": data.get("last_seen")
+            }
+            # The sensors:latest projection read by GET /sensors/latest decides whether the reading is
+            # the newest one, the per-sensor key is only overwritten then
+            if not LatestReadings(database).set(data.get("sensor_id"), reading):
+                logging.info(f"Redis: Skipped a reading of sensor {data.get('sensor_id')} older than the latest one")
+                return
+            database.set(
+                key=str(data.get("sensor_id")),
+                value=json.dumps(reading)
+            )
+        else:
+            logging.error(f"Redis: Action {action} not supported")
         
     def close(self):
-        super().close()    
\ No newline at end of file
+        super().close()    
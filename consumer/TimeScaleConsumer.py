@@ -1,49 +1,60 @@
-import json
 import os
 import sys
 import logging
+import psycopg2
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from shared.subscriber import Subscriber
-from shared.timescale import Timescale
-from shared.message import MessageStrcuture
+from shared.timescale import Timescale, get_pool
+from shared.redis_client import RedisClient
+from shared.bucket_cache import BucketCache
 
 
 class TimeScaleConsumer(Subscriber):
+    connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
     def __init__(self, config):
         super().__init__(config)
+        self.cache = BucketCache(RedisClient(host="redis"))
+
+    def connect_sink(self):
+        # The sink is the connection pool, every batch borrows a connection from it
+        return get_pool()
 
-    def consume(self):
-        def callback(ch, method, properties, body: MessageStrcuture):
-            database = Timescale()
-            message = json.loads(body)
-            action = message.get("action")
-            data = message.get("data")
-
-            logging.info(f"Timescale: Received message of action: {action}")
-            logging.info(f"Timescale: Data: {data}, type: {type(data)}")
-
-            if action == "insert_data":
-                logging.info(f"Timescale: Inserting data {data} with key {data.get('sensor_id')}")
-                database.insert_data(
-                    sensor_id=data.get("sensor_id"),
-                    velocity=data.get("velocity"),
-                    temperature=data.get("temperature"),
-                    humidity=data.get("humidity"),
-                    battery_level=data.get("battery_level"),
-                    last_seen=data.get("last_seen")
-                )
+    def handle_batch(self, messages):
+        readings = []
+        for action, data in messages:
+            if action in ("insert_data", "reading"):
+                readings.append(data)
             else:
                 logging.error(f"Timescale: Action {action} not supported")
+
+        if not readings:
+            return
+
+        # The whole batch is written in one transaction, the subscriber acks it after the commit
+        database = Timescale(pool=self.get_sink())
+        try:
+            database.insert_many(readings)
+            # Late readings are below the rollups' watermark, the cache must only be dropped once the
+            # rollups include them or the next read caches the stale buckets again. A failed refresh
+            # gets the batch redelivered, the insert is then a no-op and the refresh runs again.
+            refreshed = database.refresh_rollups(reading.get("last_seen") for reading in readings)
+        finally:
             database.close()
+        logging.info(f"Timescale: Inserted a batch of {len(readings)} readings")
+        for view, start, end in refreshed:
+            logging.info(f"Timescale: Refreshed {view} from {start} to {end}")
+
+        # The batch is already committed, a failure here must not get it redelivered
         try:
-            self.channel.basic_consume(queue=self.queue_name, on_message_callback=callback, auto_ack=True)
-            logging.info("Timescale: Started consuming messages")
-            self.channel.start_consuming()
+            invalidated = self.cache.invalidate_readings(readings)
+            if invalidated:
+                logging.info(f"Timescale: Invalidated the cached buckets of sensors {sorted(invalidated)}")
         except Exception as e:
-            logging.error(f"Error during consumption: {e}")
-            raise e
-        
+            logging.error(f"Timescale: Could not invalidate the cached buckets: {e}")
+
     def close(self):
         super().close()
-    
\ No newline at end of file
+        self.cache.redis.close()
+    
@@ -2,6 +2,9 @@ import json
 import os
 import sys
 import logging
+import signal
+import time
+import multiprocessing
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from shared.subscriber import Subscriber
@@ -19,25 +22,109 @@ dict_dependencies = {
     'test': Subscriber  
 }
 
+# Seconds a worker has to flush its batch after SIGTERM before it is killed
+SHUTDOWN_TIMEOUT = 30
+# A worker that stayed up this long is considered healthy again and restarts without backoff
+STABLE_AFTER = 60
+MAX_BACKOFF = 60
+
+
+def run_worker(config):
+    # Ctrl-C reaches the whole process group, let the supervisor coordinate the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    subscriber = dict_dependencies[config["queue_name"]](config)
+    # SIGTERM stops consuming, close() then flushes the pending batch and acks it
+    signal.signal(signal.SIGTERM, lambda signum, frame: subscriber.stop())
+    subscriber.consume()
+    subscriber.close()
+
+
+class Worker:
+    def __init__(self, config, index):
+        self.config = config
+        self.name = f"{config['queue_name']}-{index}"
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.restart_at = 0
+
+    def start(self):
+        self.process = multiprocessing.Process(target=run_worker, args=(self.config,), name=self.name)
+        self.process.start()
+        self.started_at = time.monotonic()
+        logging.info(f"Supervisor: started worker {self.name} (pid {self.process.pid})")
+
+
+class Supervisor:
+    """
+    Runs `workers` consumer processes for every config, restarts the ones that die with
+    exponential backoff and forwards SIGTERM/SIGINT to them so they can flush in-flight batches.
+    """
+
+    def __init__(self, configs):
+        self.workers = [Worker(config, index) for config in configs for index in range(config.get("workers", 1))]
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in self.workers:
+            worker.start()
+
+        while not self.stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    continue
+                if worker.restart_at == 0:
+                    if now - worker.started_at >= STABLE_AFTER:
+                        worker.restarts = 0
+                    backoff = min(2 ** worker.restarts, MAX_BACKOFF)
+                    worker.restarts += 1
+                    worker.restart_at = now + backoff
+                    logging.error(f"Supervisor: worker {worker.name} exited with code {worker.process.exitcode}, restarting in {backoff}s")
+                elif now >= worker.restart_at:
+                    worker.restart_at = 0
+                    worker.start()
+            time.sleep(1)
+
+        self.shutdown()
+
+    def stop(self, signum, frame):
+        logging.info(f"Supervisor: received signal {signum}, stopping workers")
+        self.stopping = True
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker in self.workers:
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logging.error(f"Supervisor: worker {worker.name} did not stop in time, killing it")
+                worker.process.kill()
+                worker.process.join()
+        logging.info("Supervisor: all workers stopped")
+
+
 if __name__ == "__main__":
     print("Starting subscriber...")
-    if len(sys.argv) != 2:
-        print("Usage: python main.py <config_file>")
+    if len(sys.argv) < 2:
+        print("Usage: python main.py <config_file> [<config_file> ...]")
         sys.exit(1)
 
-    config_file = sys.argv[1]
-    
-    try:
-        with open(config_file, 'r') as file:
-            config = json.load(file)
-    except Exception as e:
-        logging.error(f"Failed to load config file {config_file}: {e}")
-        sys.exit(1)
+    configs = []
+    for config_file in sys.argv[1:]:
+        try:
+            with open(config_file, 'r') as file:
+                configs.append(json.load(file))
+        except Exception as e:
+            logging.error(f"Failed to load config file {config_file}: {e}")
+            sys.exit(1)
 
     try:
-        subscriber = dict_dependencies[config["queue_name"]](config)
-        subscriber.consume()
-        subscriber.close()
+        Supervisor(configs).run()
     except Exception as e:
         logging.error(f"Failed to start subscriber: {e}")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import sys
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from shared.subscriber import Subscriber
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def list_parked(subscriber, limit):
+    """Prints up to `limit` parked messages without removing them from the parking queue."""
+    delivery_tags = []
+    for _ in range(limit):
+        method, properties, body = subscriber.channel.basic_get(queue=subscriber.parking_queue)
+        if method is None:
+            break
+        delivery_tags.append(method.delivery_tag)
+        headers = properties.headers or {}
+        try:
+            message = subscriber.decode(properties, body)
+        except Exception as e:
+            message = f"<undecodable: {e}>"
+        print(json.dumps({
+            "retries": headers.get("x-retry-count"),
+            "last_error": headers.get("x-last-error"),
+            "message": message,
+        }, default=str))
+    # Give the messages back to the parking queue
+    if delivery_tags:
+        subscriber.channel.basic_nack(delivery_tag=delivery_tags[-1], multiple=True, requeue=True)
+    print(f"{len(delivery_tags)} parked messages listed")
+
+
+def replay_parked(subscriber, limit):
+    """Moves up to `limit` parked messages back to the queue with a fresh retry count."""
+    replayed = 0
+    for _ in range(limit):
+        method, properties, body = subscriber.channel.basic_get(queue=subscriber.parking_queue)
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        headers.pop("x-retry-count", None)
+        headers.pop("x-last-error", None)
+        properties.headers = headers
+        subscriber.channel.basic_publish(exchange='', routing_key=subscriber.queue_name, body=body, properties=properties)
+        subscriber.channel.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+    print(f"{replayed} parked messages replayed to {subscriber.queue_name}")
+
+
+def purge_parked(subscriber):
+    result = subscriber.channel.queue_purge(queue=subscriber.parking_queue)
+    print(f"{result.method.message_count} parked messages purged")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and replay the messages parked by a consumer")
+    parser.add_argument("config_file", help="consumer config file of the queue, e.g. consumer/config3.json")
+    parser.add_argument("command", choices=["list", "replay", "purge"])
+    parser.add_argument("--limit", type=int, default=100, help="maximum number of messages to list or replay")
+    args = parser.parse_args()
+
+    try:
+        with open(args.config_file, 'r') as file:
+            config = json.load(file)
+    except Exception as e:
+        logging.error(f"Failed to load config file {args.config_file}: {e}")
+        sys.exit(1)
+
+    # Subscriber declares the parking queue and knows how to decode the messages
+    subscriber = Subscriber(config)
+    try:
+        if args.command == "list":
+            list_parked(subscriber, args.limit)
+        elif args.command == "replay":
+            replay_parked(subscriber, args.limit)
+        else:
+            purge_parked(subscriber)
+    finally:
+        subscriber.close()
@@ -0,0 +1,18 @@
+-- sensor_data hypertable, written by Timescale.insert_data, insert_many and copy_readings
+-- depends: 
+
+CREATE TABLE IF NOT EXISTS sensor_data (
+    time TIMESTAMPTZ NOT NULL,
+    sensor_id INT NOT NULL,
+    temperature DOUBLE PRECISION,
+    humidity DOUBLE PRECISION,
+    battery_level DOUBLE PRECISION,
+    velocity DOUBLE PRECISION,
+    PRIMARY KEY (time, sensor_id)
+);
+
+-- One-day chunks keep the open chunk and its index in memory at our ingest rate, and are
+-- the unit compression and retention work on.
+SELECT create_hypertable('sensor_data', 'time',
+    chunk_time_interval => INTERVAL '1 day',
+    if_not_exists => true);
@@ -0,0 +1,43 @@
+-- Hourly and daily rollups of sensor_data, used by Timescale.get_data
+-- depends: 20240501_01_sensor_data
+-- transactional: false
+
+-- Sums and counts instead of averages, so coarser buckets (week, month) can be merged exactly.
+-- materialized_only = false merges the not yet materialized real-time tail into every query.
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_hourly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT sensor_id,
+       time_bucket(INTERVAL '1 hour', time) AS bucket,
+       SUM(temperature) AS temperature_sum, COUNT(temperature) AS temperature_count,
+       SUM(humidity) AS humidity_sum, COUNT(humidity) AS humidity_count,
+       SUM(battery_level) AS battery_level_sum, COUNT(battery_level) AS battery_level_count,
+       SUM(velocity) AS velocity_sum, COUNT(velocity) AS velocity_count
+FROM sensor_data
+GROUP BY sensor_id, bucket
+WITH NO DATA;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT sensor_id,
+       time_bucket(INTERVAL '1 day', time) AS bucket,
+       SUM(temperature) AS temperature_sum, COUNT(temperature) AS temperature_count,
+       SUM(humidity) AS humidity_sum, COUNT(humidity) AS humidity_count,
+       SUM(battery_level) AS battery_level_sum, COUNT(battery_level) AS battery_level_count,
+       SUM(velocity) AS velocity_sum, COUNT(velocity) AS velocity_count
+FROM sensor_data
+GROUP BY sensor_id, bucket
+WITH NO DATA;
+
+-- start_offset => NULL keeps backfilled history correct, refreshes only recompute the
+-- buckets invalidated since the previous run
+SELECT add_continuous_aggregate_policy('sensor_data_hourly',
+    start_offset => NULL,
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '15 minutes',
+    if_not_exists => true);
+
+SELECT add_continuous_aggregate_policy('sensor_data_daily',
+    start_offset => NULL,
+    end_offset => INTERVAL '1 day',
+    schedule_interval => INTERVAL '1 hour',
+    if_not_exists => true);
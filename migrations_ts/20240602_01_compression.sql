@@ -0,0 +1,14 @@
+-- Native columnar compression of sensor_data chunks older than a week
+-- depends: 20240601_01_continuous_aggregates
+
+-- Segmenting by sensor_id stores each sensor's readings as its own compressed batch, so
+-- get_data only decompresses the sensor it asks for. Ordering by time DESC keeps the
+-- per-column min/max metadata tight for the time range filter.
+ALTER TABLE sensor_data SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'sensor_id',
+    timescaledb.compress_orderby = 'time DESC'
+);
+
+-- The continuous aggregates finish refreshing a chunk well before it is compressed
+SELECT add_compression_policy('sensor_data', INTERVAL '7 days', if_not_exists => true);
@@ -0,0 +1,56 @@
+"""
+Retention policy of the raw sensor_data hypertable.
+
+Chunks older than TS_RETENTION_DAYS (365 by default) are dropped. A continuous aggregate
+refreshed over dropped chunks deletes its buckets there, so the refresh policies of the
+hourly and daily rollups are limited to the last TS_RETENTION_DAYS - 1 days and the
+bucketed history older than that is kept.
+Set TS_RETENTION_DAYS=0 to keep the raw data forever.
+"""
+import os
+
+from yoyo import step
+
+__depends__ = {"20240602_01_compression"}
+
+RETENTION_DAYS = int(os.environ.get("TS_RETENTION_DAYS", 365))
+
+# (view, end_offset, schedule_interval) of the refresh policies in 20240601_01_continuous_aggregates
+REFRESH_POLICIES = (
+    ("sensor_data_hourly", "1 hour", "15 minutes"),
+    ("sensor_data_daily", "1 day", "1 hour"),
+)
+
+
+def set_refresh_start(cursor, start_offset):
+    # A NULL start_offset refreshes the whole history
+    for view, end_offset, schedule_interval in REFRESH_POLICIES:
+        cursor.execute("SELECT remove_continuous_aggregate_policy(%s, if_exists => true)", (view,))
+        cursor.execute(
+            "SELECT add_continuous_aggregate_policy(%s, start_offset => %s::interval, "
+            "end_offset => %s::interval, schedule_interval => %s::interval)",
+            (view, start_offset, end_offset, schedule_interval)
+        )
+
+
+def apply_retention(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT remove_retention_policy('sensor_data', if_exists => true)")
+    if RETENTION_DAYS > 0:
+        cursor.execute(
+            "SELECT add_retention_policy('sensor_data', %s::interval)",
+            (f"{RETENTION_DAYS} days",)
+        )
+        # One day short of the retention interval, the oldest chunk still kept is never refreshed
+        set_refresh_start(cursor, f"{RETENTION_DAYS - 1} days")
+    else:
+        set_refresh_start(cursor, None)
+
+
+def rollback_retention(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT remove_retention_policy('sensor_data', if_exists => true)")
+    set_refresh_start(cursor, None)
+
+
+steps = [step(apply_retention, rollback_retention)]
@@ -0,0 +1,169 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from shared.downsampling import downsample
+from shared.timescale import _parse_timestamp
+
+# Bucket sizes the cache can align the same way time_bucket does
+BUCKET_SIZES = ("hour", "day", "week", "month")
+
+# Cached value of a finalised bucket without readings
+EMPTY = "null"
+
+
+def bucket_start(timestamp, bucket_size):
+    """
+    Start of the time_bucket of `timestamp`, in UTC.
+
+    Note:
+        - Weeks start on Monday and months on their first day, like time_bucket's default origin.
+    """
+    timestamp = timestamp.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if bucket_size == "hour":
+        return timestamp
+    timestamp = timestamp.replace(hour=0)
+    if bucket_size == "week":
+        return timestamp - timedelta(days=timestamp.weekday())
+    if bucket_size == "month":
+        return timestamp.replace(day=1)
+    return timestamp
+
+
+def next_bucket(start, bucket_size):
+    if bucket_size == "hour":
+        return start + timedelta(hours=1)
+    if bucket_size == "day":
+        return start + timedelta(days=1)
+    if bucket_size == "week":
+        return start + timedelta(weeks=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+class BucketCache:
+    """
+    Redis cache of the finalised buckets returned by `Timescale.get_data`.
+
+    A bucket is finalised once it ended more than `grace` seconds ago. Its average does not change
+    anymore, unless a late reading lands in it, in which case the consumer calls `invalidate`.
+    Each (sensor_id, bucket_size) is a hash keyed by the bucket start.
+
+    The buckets are read through the continuous aggregates, so a late reading must be refreshed
+    into them (`Timescale.refresh_rollups`) before its buckets are invalidated. Invalidating first
+    would let the next read cache the stale rollup value for the whole TTL.
+    """
+
+    def __init__(self, redis, grace=None, ttl=None):
+        """
+        Args:
+            redis (RedisClient): The client the buckets are stored with.
+            grace (float, optional): Seconds after its end a bucket is still considered open. Defaults to TS_CACHE_GRACE or 300.
+            ttl (float, optional): Seconds a sensor's cached buckets live after their last write. Defaults to TS_CACHE_TTL or 7 days.
+        """
+        self.redis = redis
+        self.grace = grace if grace is not None else float(os.environ.get("TS_CACHE_GRACE", 300))
+        self.ttl = int(ttl if ttl is not None else float(os.environ.get("TS_CACHE_TTL", 7 * 24 * 3600)))
+
+    def _key(self, sensor_id, bucket_size):
+        return f"sensor_data_cache:{sensor_id}:{bucket_size}"
+
+    def get_data(self, timescale, sensor_id, from_date, to_date, bucket_size, max_points=None, method="lttb"):
+        """
+        Same as `Timescale.get_data`, serving the finalised buckets fully inside the range from the cache.
+
+        Args:
+            timescale (Timescale): The client the missing buckets are queried with.
+
+        Returns:
+            list: The (bucket, temperature, humidity, battery_level, velocity) tuples, ordered by bucket.
+
+        Note:
+            - Only the hull of the buckets that are not cached is queried, a refresh of an already
+              seen range queries just its open tail.
+            - max_points and method are applied as in `Timescale.get_data`.
+        """
+        try:
+            start = _parse_timestamp(from_date)
+            end = _parse_timestamp(to_date)
+        except (TypeError, ValueError):
+            start = end = None
+        if bucket_size not in BUCKET_SIZES or start is None or end < start:
+            return timescale.get_data(sensor_id, from_date=from_date, to_date=to_date, bucket_size=bucket_size,
+                                      max_points=max_points, method=method)
+
+        # Buckets covering [start, end]; only the ones fully inside it and finalised can be cached
+        finalised_before = datetime.now(timezone.utc) - timedelta(seconds=self.grace)
+        buckets = []
+        bucket = bucket_start(start, bucket_size)
+        while bucket <= end:
+            following = next_bucket(bucket, bucket_size)
+            buckets.append((bucket, bucket >= start and following <= end and following <= finalised_before))
+            bucket = following
+
+        key = self._key(sensor_id, bucket_size)
+        cacheable = [bucket for bucket, cacheable in buckets if cacheable]
+        cached = {}
+        if cacheable:
+            values = self.redis.hmget(key, [bucket.isoformat() for bucket in cacheable])
+            cached = {bucket: value for bucket, value in zip(cacheable, values) if value is not None}
+
+        missing = [bucket for bucket, _ in buckets if bucket not in cached]
+        rows = {}
+        if missing:
+            # The first bucket may start before from_date, the query then starts at from_date as requested
+            query_from = max(missing[0], start)
+            query_to = min(next_bucket(missing[-1], bucket_size), end)
+            fetched = timescale.get_data(sensor_id, from_date=query_from.isoformat(), to_date=query_to.isoformat(), bucket_size=bucket_size)
+            for row in fetched:
+                bucket = row[0].astimezone(timezone.utc)
+                # The hull can overlap cached buckets at its edges, the cached value is the complete one
+                if bucket not in cached:
+                    rows[bucket] = (bucket,) + tuple(row[1:])
+
+            new = {bucket.isoformat(): json.dumps(rows[bucket][1:]) if bucket in rows else EMPTY
+                   for bucket in cacheable if bucket not in cached}
+            if new:
+                self.redis.hset(key, mapping=new)
+                self.redis.expire(key, self.ttl)
+
+        for bucket, value in cached.items():
+            if value.decode() != EMPTY:
+                rows[bucket] = (bucket,) + tuple(json.loads(value))
+        # Downsampled after the merge, the cache always holds every bucket
+        return downsample([rows[bucket] for bucket in sorted(rows)], max_points, method)
+
+    def invalidate(self, sensor_id):
+        """
+        Drops every cached bucket of a sensor.
+        """
+        self.redis.delete(*[self._key(sensor_id, bucket_size) for bucket_size in BUCKET_SIZES])
+
+    def invalidate_readings(self, readings):
+        """
+        Drops the cached buckets the readings can change, called after they are stored and refreshed
+        into the rollups.
+
+        Args:
+            readings (list): Dicts with at least the sensor_id and last_seen keys.
+
+        Returns:
+            set: The sensor IDs whose buckets were dropped.
+
+        Note:
+            - Readings newer than the grace period land in open buckets, which are never cached,
+              so only sensors with late readings are invalidated.
+        """
+        finalised_before = datetime.now(timezone.utc) - timedelta(seconds=self.grace)
+        sensors = set()
+        for reading in readings:
+            try:
+                late = _parse_timestamp(reading.get("last_seen")) < finalised_before
+            except (TypeError, ValueError):
+                late = True
+            if late:
+                sensors.add(reading.get("sensor_id"))
+        for sensor_id in sensors:
+            self.invalidate(sensor_id)
+        return sensors
@@ -1,143 +1,918 @@
-from cassandra.cluster import Cluster
+from cassandra.cluster import Cluster, NoHostAvailable
+from cassandra.concurrent import execute_concurrent
 from cassandra.policies import DCAwareRoundRobinPolicy
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
 
+from collections import Counter, namedtuple
+import argparse
 import logging
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+KEYSPACE = "sensor"
+
+# Default TTL of sensor_data_by_day in days, 0 keeps the readings forever
+DATA_TTL_DAYS = int(os.environ.get("CASSANDRA_DATA_TTL_DAYS", 0))
+
+# Days a counted reading is remembered, a reading redelivered later than that is counted again
+STATS_DEDUP_TTL_DAYS = int(os.environ.get("CASSANDRA_STATS_DEDUP_TTL_DAYS", 30))
+
+# Applied by `create_schema`, run as a migration step with `python -m shared.cassandra_client`
+SCHEMA = [
+    f"""
+    CREATE KEYSPACE IF NOT EXISTS {KEYSPACE}
+    WITH replication = {{'class': 'SimpleStrategy', 'replication_factor': 1}}
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_data (
+        sensor_id int,
+        last_seen timestamp,
+        type text,
+        temperature float,
+        velocity float,
+        PRIMARY KEY (sensor_id, last_seen)
+    )
+    """,
+    # One partition per sensor and UTC day, newest readings first, replacing the ever-growing
+    # sensor_data partitions. sensor_data is only read by the backfill.
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_data_by_day (
+        sensor_id int,
+        day_bucket date,
+        last_seen timestamp,
+        type text,
+        temperature float,
+        velocity float,
+        PRIMARY KEY ((sensor_id, day_bucket), last_seen)
+    ) WITH CLUSTERING ORDER BY (last_seen DESC)
+    """,
+    # The day buckets each sensor has data in, to delete a sensor without scanning
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_data_days (
+        sensor_id int,
+        day_bucket date,
+        PRIMARY KEY (sensor_id, day_bucket)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_type (
+        sensor_id int,
+        type text,
+        PRIMARY KEY (type, sensor_id)
+    )
+    """,
+    # Temperature statistics maintained at ingest, so /sensors/temperature/values reads one
+    # partition per type. Counters can not share a table with regular columns.
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_temperature_totals (
+        type text,
+        sensor_id int,
+        count counter,
+        sum_milli counter,
+        PRIMARY KEY (type, sensor_id)
+    )
+    """,
+    # Readings already added to sensor_temperature_totals, so a redelivered reading is not counted
+    # twice. One partition per reading, the claims of a busy sensor do not contend with each other.
+    # Only kept for the redelivery window.
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_temperature_claims (
+        sensor_id int,
+        last_seen timestamp,
+        PRIMARY KEY ((sensor_id, last_seen))
+    ) WITH default_time_to_live = {STATS_DEDUP_TTL_DAYS * 24 * 3600}
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_temperature_extremes (
+        type text,
+        sensor_id int,
+        min_temperature double,
+        max_temperature double,
+        PRIMARY KEY (type, sensor_id)
+    )
+    """,
+    # Number of sensors of each type, all in the single SENSOR_COUNTS_SCOPE partition
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_type_counts (
+        scope text,
+        type text,
+        quantity counter,
+        PRIMARY KEY (scope, type)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_battery_level (
+        sensor_id int,
+        battery_level float,
+        band int,
+        PRIMARY KEY (sensor_id)
+    )
+    """,
+    # Sensors by tenth of battery level, so low battery lookups read a few band partitions
+    f"""
+    CREATE TABLE IF NOT EXISTS {KEYSPACE}.sensor_battery_band (
+        band int,
+        sensor_id int,
+        battery_level float,
+        PRIMARY KEY (band, sensor_id)
+    )
+    """,
+]
+
+SENSOR_COUNTS_SCOPE = "all"
+
+# Number of battery bands below 100%, band b holds the levels in [b / BATTERY_BANDS, (b + 1) / BATTERY_BANDS)
+BATTERY_BANDS = 10
+
+# A bound write and where it lands, used by `execute_writes` to group writes by partition
+# and to keep only the last write of a row
+Write = namedtuple("Write", ["table", "partition", "key", "statement"])
+
+
+def _timestamp(value):
+    # Prepared statements bind timestamps as datetimes, the messages carry ISO 8601 strings
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def _day_bucket(timestamp):
+    # The driver reads timestamps back as naive UTC datetimes
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.date()
+
+
+def _battery_band(battery_level):
+    # Rounded to the float the level is stored as first, a level right on a band edge
+    # (0.7 is 0.6999999881 as a float) must get the same band when it is read back
+    battery_level = struct.unpack("f", struct.pack("f", battery_level))[0]
+    return min(max(int(battery_level * BATTERY_BANDS), 0), BATTERY_BANDS)
+
+
+def _stored_band(row):
+    # The band row a sensor_battery_level row points to, rows written before the band column get it recomputed
+    if row is None:
+        return None
+    if row.band is not None:
+        return row.band
+    if row.battery_level is not None:
+        return _battery_band(row.battery_level)
+    return None
+
+
 class CassandraClient:
+    """
+    Client of the sensor keyspace. Statements are prepared once per session, on first use, and
+    the bound statements reused afterwards.
+
+    The cluster and session are meant to be shared by the whole process through `instance`,
+    creating one per request throws away the connections and the prepared statements.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
     def __init__(self, hosts):
-        # Connect to the Cassandra cluster
+        # Connect to the Cassandra cluster, the schema is created by `create_schema`
         self.cluster = Cluster(hosts, protocol_version=4,load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='datacenter1')
 )
         self.session = self.cluster.connect()
-        self.session.execute("""
-        CREATE KEYSPACE IF NOT EXISTS sensor
-        WITH replication = {'class': 'SimpleStrategy', 'replication_factor': 1};
-        """)
-        self.session.set_keyspace('sensor')
-        self.create_table()
-
-    def create_table(self):
-        # Create a table for sensor data
-        self.session.execute("""
-        CREATE TABLE IF NOT EXISTS sensor_data (
-            sensor_id int,
-            last_seen timestamp,
-            type text,
-            temperature float,
-            velocity float,
-            PRIMARY KEY (sensor_id, last_seen)
-        )
-        """)
+        self._statements = {}
+        self._statements_lock = threading.Lock()
+        # Last known (min, max) temperature of each (type, sensor_id), readings inside it need no LWT
+        self._extremes = {}
 
-        self.session.execute("""
-        CREATE TABLE IF NOT EXISTS sensor_type (
-            sensor_id int,
-            type text,
-            PRIMARY KEY (type, sensor_id)
-        )
-        """)
+    @classmethod
+    def instance(cls, hosts=None):
+        """
+        Returns the process-wide client, connecting it on first use.
 
-        self.session.execute("""
-        CREATE TABLE IF NOT EXISTS sensor_battery_level (
-            sensor_id int,
-            battery_level float,
-            PRIMARY KEY (sensor_id)
-        )
-        """)
+        Args:
+            hosts (list, optional): The contact points, used only when the client is created.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(hosts or ["cassandra"])
+            return cls._instance
+
+    @classmethod
+    def close_instance(cls):
+        if cls._instance is not None:
+            cls._instance.close()
+
+    def create_schema(self):
+        for statement in SCHEMA:
+            self.session.execute(statement)
+        # Applied on every migration, so changing CASSANDRA_DATA_TTL_DAYS only needs a new run.
+        # A day is rewritten with every reading, so it expires with the last reading of that day.
+        for table in ("sensor_data_by_day", "sensor_data_days"):
+            self.session.execute(
+                f"ALTER TABLE {KEYSPACE}.{table} WITH default_time_to_live = {DATA_TTL_DAYS * 24 * 3600}")
+        # Added after sensor_battery_level was first created, the rows written before have no band
+        self.cluster.refresh_table_metadata(KEYSPACE, "sensor_battery_level")
+        if "band" not in self.cluster.metadata.keyspaces[KEYSPACE].tables["sensor_battery_level"].columns:
+            self.session.execute(f"ALTER TABLE {KEYSPACE}.sensor_battery_level ADD band int")
+        # Replaced by sensor_temperature_claims, its claims shared the sensor partition
+        self.session.execute(f"DROP TABLE IF EXISTS {KEYSPACE}.sensor_temperature_counted")
+
+    def prepare(self, query):
+        """
+        Returns the prepared statement of a CQL query, preparing it on the first call.
+        """
+        statement = self._statements.get(query)
+        if statement is None:
+            with self._statements_lock:
+                statement = self._statements.get(query)
+                if statement is None:
+                    statement = self.session.prepare(query)
+                    self._statements[query] = statement
+        return statement
 
     def get_session(self):
         return self.session
 
     def close(self):
         self.cluster.shutdown()
+        with CassandraClient._instance_lock:
+            if CassandraClient._instance is self:
+                CassandraClient._instance = None
 
     def execute(self, query):
         return self.get_session().execute(query)
 
     def insert_data(self, sensor_id, last_seen, sensor_type, temperature=None, velocity=None):
-        query = """
-            INSERT INTO sensor_data (sensor_id, last_seen, type, temperature, velocity) 
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        self.session.execute(query, (sensor_id, last_seen,
-                             sensor_type, temperature, velocity))
+        self.execute_writes(self.data_writes(sensor_id, last_seen, sensor_type, temperature, velocity))
 
     def insert_sensor_type(self, sensor_id, sensor_type):
-        query = """
-            INSERT INTO sensor_type (sensor_id, type) 
-            VALUES (%s, %s)
-        """
-        self.session.execute(query, (sensor_id, sensor_type))
+        self.register_sensor_types([(sensor_id, sensor_type)])
 
     def insert_battery_level(self, sensor_id, battery_level):
-        query = """
-            INSERT INTO sensor_battery_level (sensor_id, battery_level) 
-            VALUES (%s, %s)
-        """
-        self.session.execute(query, (sensor_id, battery_level))
-
-    def update(self, sensor_id, battery_level=None, temperature=None, velocity=None):
-        query = """
-            UPDATE sensor_data
-            SET temperature = %s, battery_level = %s, velocity = %s
-            WHERE sensor_id = %s
-        """
-        self.session.execute(
-            query, (temperature, battery_level, velocity, sensor_id))
-
-    def get_temperature_values(self):
-        # This query returns max, min, and avg temperature values for each sensor
-        query = """
-            SELECT sensor_id, MAX(temperature) AS max_temperature, MIN(temperature) AS min_temperature, AVG(temperature) AS avg_temperature, type
-            FROM sensor_data
-            WHERE type = 'Temperatura'
-            GROUP BY sensor_id
-            ALLOW FILTERING;
-        """
-        result = self.session.execute(query)
+        self.execute_writes(self.battery_band_writes({sensor_id: battery_level}))
+
+    def data_write(self, sensor_id, last_seen, sensor_type, temperature=None, velocity=None, ttl=None):
+        """
+        Returns the write of a reading into its sensor_data_by_day partition.
+
+        Args:
+            ttl (int, optional): Seconds the row lives, instead of the table's default TTL.
+        """
+        query = f"""
+            INSERT INTO {KEYSPACE}.sensor_data_by_day (sensor_id, day_bucket, last_seen, type, temperature, velocity)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """
+        last_seen = _timestamp(last_seen)
+        day_bucket = _day_bucket(last_seen)
+        params = (sensor_id, day_bucket, last_seen, sensor_type, temperature, velocity)
+        if ttl is None:
+            statement = self.prepare(query).bind(params)
+        else:
+            statement = self.prepare(query + " USING TTL ?").bind(params + (ttl,))
+        return Write("sensor_data_by_day", (sensor_id, day_bucket), (sensor_id, day_bucket, last_seen), statement)
+
+    def data_writes(self, sensor_id, last_seen, sensor_type, temperature=None, velocity=None, ttl=None):
+        """
+        Same as `data_write`, plus the write registering the day bucket in sensor_data_days.
+        """
+        write = self.data_write(sensor_id, last_seen, sensor_type, temperature, velocity, ttl)
+        day_bucket = write.partition[1]
+        query = f"""
+            INSERT INTO {KEYSPACE}.sensor_data_days (sensor_id, day_bucket)
+            VALUES (?, ?)
+        """
+        if ttl is None:
+            statement = self.prepare(query).bind((sensor_id, day_bucket))
+        else:
+            statement = self.prepare(query + " USING TTL ?").bind((sensor_id, day_bucket, ttl))
+        return [write, Write("sensor_data_days", sensor_id, (sensor_id, day_bucket), statement)]
+
+    def get_data_range(self, sensor_id, start, end, concurrency=16):
+        """
+        Reads the readings of a sensor between two timestamps, querying its day partitions in parallel.
+
+        Args:
+            sensor_id (int): The ID of the sensor.
+            start (datetime or str): The first timestamp, inclusive.
+            end (datetime or str): The last timestamp, inclusive.
+            concurrency (int, optional): The maximum number of partitions read at once.
+
+        Returns:
+            list: Dicts with the sensor_id, last_seen, type, temperature and velocity of every reading, newest first.
+        """
+        start, end = _timestamp(start), _timestamp(end)
+        first, last = _day_bucket(start), _day_bucket(end)
+        days = [last - timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+        query = f"""
+            SELECT sensor_id, last_seen, type, temperature, velocity
+            FROM {KEYSPACE}.sensor_data_by_day
+            WHERE sensor_id = ? AND day_bucket = ? AND last_seen >= ? AND last_seen <= ?
+        """
+        statement = self.prepare(query)
+        # Newest day first, each partition is already ordered newest first
+        results = execute_concurrent(self.session, [(statement, (sensor_id, day, start, end)) for day in days],
+                                     concurrency=concurrency, raise_on_first_error=True)
+        return [{
+            "sensor_id": row.sensor_id,
+            "last_seen": row.last_seen,
+            "type": row.type,
+            "temperature": row.temperature,
+            "velocity": row.velocity
+        } for _, result in results for row in result]
+
+    def register_sensor_types(self, sensors, concurrency=32):
+        """
+        Inserts sensors into sensor_type and counts the new ones in sensor_type_counts.
+
+        Args:
+            sensors (list): (sensor_id, sensor_type) tuples.
+            concurrency (int, optional): The maximum number of requests in flight.
+
+        Returns:
+            int: The number of sensors that were not registered yet.
+
+        Note:
+            - The insert is a lightweight transaction and only an applied insert is counted, so a
+              redelivered message does not count a sensor twice.
+        """
+        query = f"""
+            INSERT INTO {KEYSPACE}.sensor_type (sensor_id, type)
+            VALUES (?, ?) IF NOT EXISTS
+        """
+        statement = self.prepare(query)
+        sensors = list(dict.fromkeys(sensors))
+        results = execute_concurrent(self.session, [(statement, sensor) for sensor in sensors],
+                                     concurrency=concurrency, raise_on_first_error=True)
+        added = Counter(sensor_type for (_, sensor_type), (_, result) in zip(sensors, results) if result.was_applied)
+        self._add_sensor_counts(added, concurrency)
+        return sum(added.values())
+
+    def unregister_sensor_type(self, sensor_id, sensor_type):
+        """
+        Deletes a sensor from sensor_type and, if it was there, uncounts it.
+        """
+        query = f"""
+            DELETE FROM {KEYSPACE}.sensor_type
+            WHERE type = ? AND sensor_id = ? IF EXISTS
+        """
+        if self.session.execute(self.prepare(query), (sensor_type, sensor_id)).was_applied:
+            self._add_sensor_counts({sensor_type: -1})
+
+    def _add_sensor_counts(self, deltas, concurrency=32):
+        query = f"""
+            UPDATE {KEYSPACE}.sensor_type_counts SET quantity = quantity + ?
+            WHERE scope = ? AND type = ?
+        """
+        statement = self.prepare(query)
+        requests = [(statement, (delta, SENSOR_COUNTS_SCOPE, sensor_type))
+                    for sensor_type, delta in deltas.items() if delta]
+        if requests:
+            execute_concurrent(self.session, requests, concurrency=concurrency, raise_on_first_error=True)
+
+    def reconcile_sensor_type_counts(self, page_size=1000):
+        """
+        Recounts sensor_type and corrects sensor_type_counts where it drifted.
+
+        Returns:
+            dict: The correction applied to each type.
+
+        Note:
+            - Sensors registered or deleted while it runs can be counted in the scan but not in the
+              counters, or the other way around. The next run repairs that drift.
+        """
+        actual = Counter()
+        result = self.session.execute(SimpleStatement(f"SELECT type FROM {KEYSPACE}.sensor_type", fetch_size=page_size))
+        for row in result:
+            actual[row.type] += 1
+
+        query = f"""
+            SELECT type, quantity FROM {KEYSPACE}.sensor_type_counts
+            WHERE scope = ?
+        """
+        counted = {row.type: row.quantity for row in self.session.execute(self.prepare(query), (SENSOR_COUNTS_SCOPE,))}
+        deltas = {sensor_type: actual[sensor_type] - counted.get(sensor_type, 0)
+                  for sensor_type in set(actual) | set(counted)}
+        deltas = {sensor_type: delta for sensor_type, delta in deltas.items() if delta}
+        self._add_sensor_counts(deltas)
+        return deltas
+
+    def battery_level_write(self, sensor_id, battery_level):
+        query = f"""
+            INSERT INTO {KEYSPACE}.sensor_battery_level (sensor_id, battery_level, band)
+            VALUES (?, ?, ?)
+        """
+        statement = self.prepare(query).bind((sensor_id, battery_level, _battery_band(battery_level)))
+        return Write("sensor_battery_level", sensor_id, (sensor_id,), statement)
+
+    def battery_band_writes(self, levels, concurrency=32):
+        """
+        Writes that store the battery levels and move their sensors to the right sensor_battery_band.
+
+        Args:
+            levels (dict): The latest battery level of each sensor ID.
+            concurrency (int, optional): The maximum number of reads in flight.
+
+        Returns:
+            list: `Write` tuples for `execute_writes`, the level, the new band row and, if the sensor
+                changed band, the delete of its previous band row.
+
+        Note:
+            - The previous band is the one stored in sensor_battery_level, so these writes must be
+              executed before the levels of those sensors change again.
+        """
+        query = f"""
+            SELECT battery_level, band FROM {KEYSPACE}.sensor_battery_level
+            WHERE sensor_id = ?
+        """
+        statement = self.prepare(query)
+        sensor_ids = list(levels)
+        results = execute_concurrent(self.session, [(statement, (sensor_id,)) for sensor_id in sensor_ids],
+                                     concurrency=concurrency, raise_on_first_error=True)
+
+        insert = self.prepare(f"""
+            INSERT INTO {KEYSPACE}.sensor_battery_band (band, sensor_id, battery_level)
+            VALUES (?, ?, ?)
+        """)
+        delete = self.prepare(f"""
+            DELETE FROM {KEYSPACE}.sensor_battery_band
+            WHERE band = ? AND sensor_id = ?
+        """)
+        writes = []
+        for sensor_id, (_, result) in zip(sensor_ids, results):
+            battery_level = levels[sensor_id]
+            band = _battery_band(battery_level)
+            old_band = _stored_band(result.one())
+            if old_band is not None and old_band != band:
+                writes.append(Write("sensor_battery_band", old_band, (old_band, sensor_id), delete.bind((old_band, sensor_id))))
+            writes.append(self.battery_level_write(sensor_id, battery_level))
+            writes.append(Write("sensor_battery_band", band, (band, sensor_id), insert.bind((band, sensor_id, battery_level))))
+        return writes
+
+    def backfill_battery_bands(self, page_size=1000, concurrency=32):
+        """
+        Rebuilds sensor_battery_band from sensor_battery_level, filling the band column of the rows
+        written before it and dropping the band rows that do not match a sensor's level.
+
+        Returns:
+            int: The number of band rows written or deleted.
+
+        Note:
+            - Levels written while it runs can be moved by the consumer in between, the next run
+              repairs the band rows left behind.
+        """
+        result = self.session.execute(SimpleStatement(
+            f"SELECT sensor_id, battery_level, band FROM {KEYSPACE}.sensor_battery_level", fetch_size=page_size))
+        levels = {row.sensor_id: row for row in result if row.battery_level is not None}
+
+        insert = self.prepare(f"""
+            INSERT INTO {KEYSPACE}.sensor_battery_band (band, sensor_id, battery_level)
+            VALUES (?, ?, ?)
+        """)
+        delete = self.prepare(f"""
+            DELETE FROM {KEYSPACE}.sensor_battery_band
+            WHERE band = ? AND sensor_id = ?
+        """)
+        writes = []
+        bands = {}
+        for sensor_id, row in levels.items():
+            band = _battery_band(row.battery_level)
+            bands[sensor_id] = band
+            if row.band != band:
+                writes.append(self.battery_level_write(sensor_id, row.battery_level))
+            writes.append(Write("sensor_battery_band", band, (band, sensor_id), insert.bind((band, sensor_id, row.battery_level))))
+
+        # One partition per band, every band row is checked against the level of its sensor
+        query = f"""
+            SELECT band, sensor_id FROM {KEYSPACE}.sensor_battery_band
+            WHERE band IN ?
+        """
+        stale = [row for row in self.session.execute(self.prepare(query), (list(range(BATTERY_BANDS + 1)),))
+                 if bands.get(row.sensor_id) != row.band]
+        for row in stale:
+            writes.append(Write("sensor_battery_band", row.band, (row.band, row.sensor_id), delete.bind((row.band, row.sensor_id))))
+        self.execute_writes(writes, concurrency=concurrency)
+        return len(levels) + len(stale)
+
+    def execute_writes(self, writes, concurrency=32, max_batch_size=50):
+        """
+        Executes writes with one request per partition, several requests in flight at once.
+
+        Args:
+            writes (list): `Write` tuples, in the order the writes happened.
+            concurrency (int, optional): The maximum number of requests in flight.
+            max_batch_size (int, optional): The maximum number of writes in one request, larger
+                partitions are split in several batches.
+
+        Returns:
+            int: The number of requests sent.
+
+        Raises:
+            Exception: The error of the first failed request.
+
+        Note:
+            - The writes of a partition are sent as an UNLOGGED batch, which the coordinator applies
+              in one mutation of the replicas owning that partition.
+            - Every write of a batch gets the same timestamp, so Cassandra can not order two writes
+              of the same row. Only the last write of each row is kept.
+        """
+        latest = {}
+        for write in writes:
+            # Re-inserting moves the row to the end, so the partitions keep the order of their last write
+            latest.pop((write.table, write.key), None)
+            latest[(write.table, write.key)] = write
+
+        partitions = {}
+        for write in latest.values():
+            partitions.setdefault((write.table, write.partition), []).append(write.statement)
+
+        requests = []
+        for statements in partitions.values():
+            for start in range(0, len(statements), max_batch_size):
+                chunk = statements[start:start + max_batch_size]
+                if len(chunk) == 1:
+                    requests.append((chunk[0], None))
+                    continue
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for statement in chunk:
+                    batch.add(statement)
+                requests.append((batch, None))
+
+        if requests:
+            execute_concurrent(self.session, requests, concurrency=concurrency, raise_on_first_error=True)
+        return len(requests)
+
+    def update_temperature_stats(self, readings, concurrency=32):
+        """
+        Adds readings to the sensor_temperature_totals and sensor_temperature_extremes tables.
+
+        Args:
+            readings (list): (sensor_type, sensor_id, last_seen, temperature) tuples, readings without
+                temperature are skipped.
+            concurrency (int, optional): The maximum number of requests in flight.
+
+        Note:
+            - Counter updates are not idempotent, so the readings are looked up in sensor_temperature_claims
+              and only the ones not claimed yet are claimed and added, with one counter update per sensor.
+              A redelivered reading is not counted twice, a failure between the claim and the counter
+              update loses it instead.
+            - The claims are plain reads and writes, one partition per reading. Two consumers counting
+              the same reading at the same moment can both count it, which needs a redelivery while
+              the first delivery is still being written.
+            - The extremes are idempotent and include every reading. They are only written, with a
+              lightweight transaction, when a reading falls outside the last known min/max of its sensor.
+        """
+        claimed = {}
+        extremes = {}
+        for sensor_type, sensor_id, last_seen, temperature in readings:
+            if temperature is None:
+                continue
+            claimed[(sensor_id, _timestamp(last_seen))] = (sensor_type, temperature)
+            low, high = extremes.get((sensor_type, sensor_id), (temperature, temperature))
+            extremes[(sensor_type, sensor_id)] = (min(low, temperature), max(high, temperature))
+
+        query = f"""
+            SELECT sensor_id FROM {KEYSPACE}.sensor_temperature_claims
+            WHERE sensor_id = ? AND last_seen = ?
+        """
+        statement = self.prepare(query)
+        keys = list(claimed)
+        results = execute_concurrent(self.session, [(statement, key) for key in keys],
+                                     concurrency=concurrency, raise_on_first_error=True)
+        keys = [key for key, (_, result) in zip(keys, results) if result.one() is None]
+
+        query = f"""
+            INSERT INTO {KEYSPACE}.sensor_temperature_claims (sensor_id, last_seen)
+            VALUES (?, ?)
+        """
+        statement = self.prepare(query)
+        if keys:
+            execute_concurrent(self.session, [(statement, key) for key in keys],
+                               concurrency=concurrency, raise_on_first_error=True)
+        totals = {}
+        for key in keys:
+            sensor_id = key[0]
+            sensor_type, temperature = claimed[key]
+            count, sum_milli = totals.get((sensor_type, sensor_id), (0, 0))
+            totals[(sensor_type, sensor_id)] = (count + 1, sum_milli + round(temperature * 1000))
+
+        query = f"""
+            UPDATE {KEYSPACE}.sensor_temperature_totals
+            SET count = count + ?, sum_milli = sum_milli + ?
+            WHERE type = ? AND sensor_id = ?
+        """
+        statement = self.prepare(query)
+        requests = [(statement, (count, sum_milli, sensor_type, sensor_id))
+                    for (sensor_type, sensor_id), (count, sum_milli) in totals.items()]
+        if requests:
+            execute_concurrent(self.session, requests, concurrency=concurrency, raise_on_first_error=True)
+
+        for (sensor_type, sensor_id), (low, high) in extremes.items():
+            self._update_extremes(sensor_type, sensor_id, low, high)
+
+    def _update_extremes(self, sensor_type, sensor_id, low, high):
+        known = self._extremes.get((sensor_type, sensor_id))
+        if known is not None and known[0] <= low and high <= known[1]:
+            return
+
+        if known is None:
+            query = f"""
+                INSERT INTO {KEYSPACE}.sensor_temperature_extremes (type, sensor_id, min_temperature, max_temperature)
+                VALUES (?, ?, ?, ?) IF NOT EXISTS
+            """
+            result = self.session.execute(self.prepare(query), (sensor_type, sensor_id, low, high))
+            if result.was_applied:
+                self._extremes[(sensor_type, sensor_id)] = (low, high)
+                return
+            row = result.one()
+            known = (row.min_temperature, row.max_temperature)
+
+        # A failed condition returns the stored value, which is then at least as extreme as ours.
+        # Without a stored value the row was deleted since it was cached, only [applied] is returned.
+        known_low, known_high = known
+        if low < known_low:
+            query = f"""
+                UPDATE {KEYSPACE}.sensor_temperature_extremes SET min_temperature = ?
+                WHERE type = ? AND sensor_id = ? IF min_temperature > ?
+            """
+            result = self.session.execute(self.prepare(query), (low, sensor_type, sensor_id, low))
+            stored = None if result.was_applied else getattr(result.one(), "min_temperature", None)
+            if not result.was_applied and stored is None:
+                return self._reset_extremes(sensor_type, sensor_id, low, high)
+            known_low = low if result.was_applied else min(stored, low)
+        if high > known_high:
+            query = f"""
+                UPDATE {KEYSPACE}.sensor_temperature_extremes SET max_temperature = ?
+                WHERE type = ? AND sensor_id = ? IF max_temperature < ?
+            """
+            result = self.session.execute(self.prepare(query), (high, sensor_type, sensor_id, high))
+            stored = None if result.was_applied else getattr(result.one(), "max_temperature", None)
+            if not result.was_applied and stored is None:
+                return self._reset_extremes(sensor_type, sensor_id, low, high)
+            known_high = high if result.was_applied else max(stored, high)
+        self._extremes[(sensor_type, sensor_id)] = (known_low, known_high)
+
+    def _reset_extremes(self, sensor_type, sensor_id, low, high):
+        # The cached extremes belong to a deleted row, start over with the INSERT IF NOT EXISTS
+        self._extremes.pop((sensor_type, sensor_id), None)
+        self._update_extremes(sensor_type, sensor_id, low, high)
+
+    def reconcile_temperature_stats(self, page_size=1000, concurrency=32):
+        """
+        Recomputes the temperature statistics from the readings in sensor_data_by_day and corrects
+        sensor_temperature_totals and sensor_temperature_extremes, seeding the sensors without any.
+
+        Returns:
+            int: The number of sensors whose totals were corrected.
+
+        Note:
+            - The totals of every sensor with stored readings are set to those readings, with a data
+              TTL the expired readings leave the average.
+            - Readings written while it runs can be counted in the scan but not in the counters, or
+              the other way around. The next run repairs that drift.
+            - The extremes are only widened, like at ingest.
+        """
+        actual = {}
+        extremes = {}
+        result = self.session.execute(SimpleStatement(
+            f"SELECT sensor_id, type, temperature FROM {KEYSPACE}.sensor_data_by_day", fetch_size=page_size))
+        for row in result:
+            if row.type is None or row.temperature is None:
+                continue
+            key = (row.type, row.sensor_id)
+            count, sum_milli = actual.get(key, (0, 0))
+            actual[key] = (count + 1, sum_milli + round(row.temperature * 1000))
+            low, high = extremes.get(key, (row.temperature, row.temperature))
+            extremes[key] = (min(low, row.temperature), max(high, row.temperature))
+
+        counted = {}
+        query = f"""
+            SELECT sensor_id, count, sum_milli FROM {KEYSPACE}.sensor_temperature_totals
+            WHERE type = ?
+        """
+        for sensor_type in {sensor_type for sensor_type, _ in actual}:
+            for row in self.session.execute(self.prepare(query), (sensor_type,)):
+                counted[(sensor_type, row.sensor_id)] = (row.count or 0, row.sum_milli or 0)
+
+        deltas = {}
+        for key, (count, sum_milli) in actual.items():
+            stored_count, stored_sum_milli = counted.get(key, (0, 0))
+            if (count, sum_milli) != (stored_count, stored_sum_milli):
+                deltas[key] = (count - stored_count, sum_milli - stored_sum_milli)
+
+        query = f"""
+            UPDATE {KEYSPACE}.sensor_temperature_totals
+            SET count = count + ?, sum_milli = sum_milli + ?
+            WHERE type = ? AND sensor_id = ?
+        """
+        statement = self.prepare(query)
+        requests = [(statement, (count, sum_milli, sensor_type, sensor_id))
+                    for (sensor_type, sensor_id), (count, sum_milli) in deltas.items()]
+        if requests:
+            execute_concurrent(self.session, requests, concurrency=concurrency, raise_on_first_error=True)
+
+        for (sensor_type, sensor_id), (low, high) in extremes.items():
+            self._update_extremes(sensor_type, sensor_id, low, high)
+        return len(deltas)
+
+    def get_temperature_values(self, sensor_type='Temperatura'):
+        # Reads the statistics maintained at ingest, one partition of each table
+        totals = self.session.execute(self.prepare(f"""
+            SELECT sensor_id, count, sum_milli
+            FROM {KEYSPACE}.sensor_temperature_totals
+            WHERE type = ?
+        """), (sensor_type,))
+        extremes = {row.sensor_id: row for row in self.session.execute(self.prepare(f"""
+            SELECT sensor_id, min_temperature, max_temperature
+            FROM {KEYSPACE}.sensor_temperature_extremes
+            WHERE type = ?
+        """), (sensor_type,))}
         # Convert the result set to a list of dictionaries for easier processing
         return [{
             "sensor_id": row.sensor_id,
-            "max_temperature": row.max_temperature,
-            "min_temperature": row.min_temperature,
-            "avg_temperature": row.avg_temperature,
-            "type": row.type
-        } for row in result]
+            "max_temperature": extremes[row.sensor_id].max_temperature if row.sensor_id in extremes else None,
+            "min_temperature": extremes[row.sensor_id].min_temperature if row.sensor_id in extremes else None,
+            "avg_temperature": row.sum_milli / row.count / 1000,
+            "type": sensor_type
+        } for row in totals if row.count]
 
     def get_sensors_quantity_type(self):
-        # This query returns the quantity of sensors grouped by type
-        # The result set will contain two columns: type and quantity
-        # The quantity column will contain the number of sensors of each type, possibly with duplicates if the same sensor is registered multiple times in the database count as 1 sensor
-
-        query = """
-            SELECT type, COUNT(type) AS quantity
-            FROM sensor_type
-            GROUP BY type
+        # This query returns the quantity of sensors of each type, maintained by register_sensor_types
+        # and unregister_sensor_type in a single partition
+        query = f"""
+            SELECT type, quantity
+            FROM {KEYSPACE}.sensor_type_counts
+            WHERE scope = ?
         """
-        result = self.session.execute(query)
+        result = self.session.execute(self.prepare(query), (SENSOR_COUNTS_SCOPE,))
         # Convert the result set to a list of dictionaries for easier processing
         return [{
             "type": row.type,
             "quantity": row.quantity
-        } for row in result]
+        } for row in result if row.quantity > 0]
+
+    def get_sensor_low_battery(self, threshold=0.2):
+        """
+        Returns the sensors with a battery level below `threshold`.
+
+        Note:
+            - Only the bands up to the threshold are read, the levels are then filtered exactly and
+              checked against sensor_battery_level, dropping the band rows left behind by concurrent
+              writers of the same sensor.
+        """
+        query = f"""
+            SELECT sensor_id, battery_level
+            FROM {KEYSPACE}.sensor_battery_band
+            WHERE band IN ?
+        """
+        bands = list(range(_battery_band(threshold) + 1))
+        candidates = {row.sensor_id: row for row in self.session.execute(self.prepare(query), (bands,))
+                      if row.battery_level < threshold}
+        if not candidates:
+            return []
 
-    def get_sensor_low_battery(self):
-        # This query returns the sensors with a battery level below 20%
-        query = """
+        query = f"""
             SELECT sensor_id, battery_level
-            FROM sensor_battery_level
-            WHERE battery_level < 0.2
-            ALLOW FILTERING;
+            FROM {KEYSPACE}.sensor_battery_level
+            WHERE sensor_id IN ?
         """
-        result = self.session.execute(query)
+        current = {row.sensor_id: row.battery_level
+                   for row in self.session.execute(self.prepare(query), (list(candidates),))}
         # Convert the result set to a list of dictionaries for easier processing
         return [{
-            "sensor_id": row.sensor_id,
-            "battery_level": round(row.battery_level, 2)
-        } for row in result]
-    
+            "sensor_id": sensor_id,
+            "battery_level": round(current[sensor_id], 2)
+        } for sensor_id in sorted(candidates)
+            if current.get(sensor_id) is not None and current[sensor_id] < threshold]
+
     def delete_sensor_data(self, sensor_id):
-        query = f"""
-            DELETE FROM sensor_data
-            WHERE sensor_id = {sensor_id} 
-        """
-        self.session.execute(query)
+        days = self.session.execute(self.prepare(f"""
+            SELECT day_bucket FROM {KEYSPACE}.sensor_data_days
+            WHERE sensor_id = ?
+        """), (sensor_id,))
+        delete = self.prepare(f"DELETE FROM {KEYSPACE}.sensor_data_by_day WHERE sensor_id = ? AND day_bucket = ?")
+        requests = [(delete, (sensor_id, row.day_bucket)) for row in days]
+        if requests:
+            execute_concurrent(self.session, requests, concurrency=16, raise_on_first_error=True)
+        # The claims of its readings expire with their TTL, until then a redelivered reading stays uncounted
+        for table in ("sensor_data_days", "sensor_data"):
+            self.session.execute(self.prepare(f"DELETE FROM {KEYSPACE}.{table} WHERE sensor_id = ?"), (sensor_id,))
+
+        band = _stored_band(self.session.execute(self.prepare(f"""
+            SELECT battery_level, band FROM {KEYSPACE}.sensor_battery_level
+            WHERE sensor_id = ?
+        """), (sensor_id,)).one())
+        if band is not None:
+            self.session.execute(self.prepare(f"DELETE FROM {KEYSPACE}.sensor_battery_band WHERE band = ? AND sensor_id = ?"),
+                                 (band, sensor_id))
+
+        # The statistics are partitioned by type, the few type partitions are listed first
+        types = self.session.execute(self.prepare(f"SELECT DISTINCT type FROM {KEYSPACE}.sensor_temperature_extremes"))
+        for row in types:
+            for table in ("sensor_temperature_totals", "sensor_temperature_extremes"):
+                self.session.execute(self.prepare(f"DELETE FROM {KEYSPACE}.{table} WHERE type = ? AND sensor_id = ?"),
+                                     (row.type, sensor_id))
+            self._extremes.pop((row.type, sensor_id), None)
+
+
+def connect(hosts, retries=30, delay=5):
+    """
+    Opens a client, waiting for Cassandra to accept connections first.
+
+    Args:
+        hosts (list): The contact points.
+        retries (int, optional): Connection attempts, `delay` seconds apart.
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            return CassandraClient(hosts)
+        except NoHostAvailable as e:
+            if attempt == retries:
+                raise
+            logging.info(f"Cassandra: Not available yet ({e}), retrying in {delay}s")
+            time.sleep(delay)
+
+
+def migrate(hosts):
+    """
+    Creates the keyspace and tables.
+    """
+    client = connect(hosts)
+    try:
+        client.create_schema()
+        logging.info(f"Cassandra: Schema of keyspace {KEYSPACE} is up to date")
+    finally:
+        client.close()
+
+
+def backfill(hosts, page_size=1000, concurrency=32):
+    """
+    Copies the readings of the old sensor_data table into sensor_data_by_day and sensor_data_days,
+    then seeds the temperature statistics from them, see `CassandraClient.reconcile_temperature_stats`,
+    and the battery bands from sensor_battery_level, see `CassandraClient.backfill_battery_bands`.
+
+    Note:
+        - It can be run again safely, the copies overwrite themselves. With a default TTL the
+          rows only live the rest of it, and readings that already outlived it are skipped.
+    """
+    client = connect(hosts)
+    try:
+        ttl = DATA_TTL_DAYS * 24 * 3600
+        now = datetime.utcnow()
+        statement = SimpleStatement(
+            f"SELECT sensor_id, last_seen, type, temperature, velocity FROM {KEYSPACE}.sensor_data",
+            fetch_size=page_size)
+        result = client.session.execute(statement)
+        copied = skipped = 0
+        while True:
+            writes = []
+            for row in result.current_rows:
+                remaining = None
+                if ttl:
+                    remaining = ttl - int((now - row.last_seen).total_seconds())
+                    if remaining <= 0:
+                        skipped += 1
+                        continue
+                writes.extend(client.data_writes(row.sensor_id, row.last_seen, row.type,
+                                                 row.temperature, row.velocity, ttl=remaining))
+                copied += 1
+            client.execute_writes(writes, concurrency=concurrency)
+            logging.info(f"Cassandra: Backfilled {copied} readings, skipped {skipped} expired")
+            if not result.has_more_pages:
+                break
+            result.fetch_next_page()
+
+        corrected = client.reconcile_temperature_stats(page_size=page_size, concurrency=concurrency)
+        logging.info(f"Cassandra: Temperature statistics of {corrected} sensors corrected")
+        bands = client.backfill_battery_bands(page_size=page_size, concurrency=concurrency)
+        logging.info(f"Cassandra: Backfilled {bands} battery band rows")
+    finally:
+        client.close()
+
+
+def reconcile(hosts):
+    """
+    Repairs the drift of sensor_type_counts, see `CassandraClient.reconcile_sensor_type_counts`.
+    """
+    client = connect(hosts)
+    try:
+        deltas = client.reconcile_sensor_type_counts()
+        logging.info(f"Cassandra: Sensor counts corrected by {deltas}" if deltas else "Cassandra: Sensor counts are correct")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Cassandra schema migration, backfill and count reconciliation of the sensor keyspace")
+    parser.add_argument("command", choices=["migrate", "backfill", "reconcile"])
+    parser.add_argument("hosts", nargs="*", default=["cassandra"])
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate(args.hosts)
+    elif args.command == "backfill":
+        backfill(args.hosts)
+    else:
+        reconcile(args.hosts)
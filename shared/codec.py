@@ -0,0 +1,59 @@
+import json
+import struct
+
+import msgpack
+
+# Bumped whenever the binary layout changes, so consumers can reject frames they do not understand
+CODEC_VERSION = 1
+
+_HEADER = struct.Struct("!B")
+
+
+class JsonCodec:
+    """
+    Text codec, kept as the fallback for producers and consumers that do not announce a content type.
+    """
+    content_type = "application/json"
+
+    def encode(self, payload):
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class MsgpackCodec:
+    """
+    Compact binary codec: a one byte version header followed by the msgpack encoded payload.
+    """
+    content_type = "application/x-msgpack"
+
+    def encode(self, payload):
+        return _HEADER.pack(CODEC_VERSION) + msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, body):
+        (version,) = _HEADER.unpack_from(body)
+        if version != CODEC_VERSION:
+            raise ValueError(f"Unsupported {self.content_type} version {version}")
+        return msgpack.unpackb(body[_HEADER.size:], raw=False)
+
+
+CODECS = {codec.content_type: codec for codec in (JsonCodec(), MsgpackCodec())}
+
+
+def get_codec(content_type=None):
+    """
+    Returns the codec registered for a content type.
+
+    Args:
+        content_type (str, optional): The AMQP content type of the message. Messages without one are JSON.
+
+    Raises:
+        ValueError: If no codec is registered for the content type.
+    """
+    if content_type is None:
+        return CODECS[JsonCodec.content_type]
+    try:
+        return CODECS[content_type]
+    except KeyError:
+        raise ValueError(f"No codec registered for content type {content_type}")
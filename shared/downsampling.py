@@ -0,0 +1,107 @@
+import numpy as np
+
+# Columns of a get_data row after the bucket, in the order the primary metric is picked
+METRICS = ("temperature", "humidity", "battery_level", "velocity")
+
+METHODS = ("lttb", "min_max")
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: keeps the points that preserve the visual shape of a series.
+
+    Args:
+        x (np.ndarray): The increasing x values.
+        y (np.ndarray): The y values.
+        threshold (int): The number of points to keep.
+
+    Returns:
+        np.ndarray: The indices of the kept points, in increasing order.
+
+    Note:
+        - The first and last points are always kept. Every bucket in between keeps the point forming
+          the largest triangle with the previously kept point and the average of the next bucket.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = x - x[0]
+    # threshold - 2 buckets over the points between the first and the last one
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    starts, ends = edges[:-1], edges[1:]
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_y = np.concatenate(([0.0], np.cumsum(y)))
+    counts = ends - starts
+    avg_x = np.append((cum_x[ends] - cum_x[starts]) / counts, x[-1])
+    avg_y = np.append((cum_y[ends] - cum_y[starts]) / counts, y[-1])
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = starts[i], ends[i]
+        area = np.abs((x[a] - avg_x[i + 1]) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y[i + 1] - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def min_max(x, y, threshold):
+    """
+    Per-pixel min/max: splits the x range in threshold / 2 equal bins and keeps the lowest
+    and the highest point of each one, so spikes are never lost.
+
+    Args:
+        x (np.ndarray): The increasing x values.
+        y (np.ndarray): The y values.
+        threshold (int): The maximum number of points to keep.
+
+    Returns:
+        np.ndarray: The indices of the kept points, in increasing order.
+    """
+    n = len(x)
+    bins = threshold // 2
+    if threshold >= n or bins < 1:
+        return np.arange(n)
+
+    span = x[-1] - x[0]
+    bin_of = np.minimum(((x - x[0]) * bins / span).astype(int), bins - 1) if span > 0 else np.zeros(n, dtype=int)
+    # Sorted by bin and then by value, the first point of a bin is its min and the last its max
+    order = np.lexsort((y, bin_of))
+    sorted_bins = bin_of[order]
+    first = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    last = np.r_[first[1:] - 1, n - 1]
+    return np.unique(np.concatenate((order[first], order[last])))
+
+
+def downsample(rows, max_points, method="lttb"):
+    """
+    Reduces `get_data` rows to at most `max_points`, keeping the shape of their primary metric.
+
+    Args:
+        rows (list): (bucket, temperature, humidity, battery_level, velocity) tuples ordered by bucket.
+        max_points (int): The maximum number of rows to return.
+        method (str, optional): 'lttb' or 'min_max'.
+
+    Returns:
+        list: The kept rows, in their original order.
+
+    Note:
+        - The primary metric is the first of METRICS with a value, rows where it is null are dropped.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown downsampling method {method}, expected one of {METHODS}")
+    if max_points is None or len(rows) <= max_points:
+        return rows
+
+    column = next((i for i in range(1, len(METRICS) + 1) if any(row[i] is not None for row in rows)), None)
+    if column is None:
+        return rows[:max_points]
+    rows = [row for row in rows if row[column] is not None]
+
+    x = np.array([row[0].timestamp() for row in rows], dtype=float)
+    y = np.array([row[column] for row in rows], dtype=float)
+    indices = lttb(x, y, max_points) if method == "lttb" else min_max(x, y, max_points)
+    return [rows[i] for i in indices]
@@ -0,0 +1,83 @@
+import json
+from datetime import datetime, timezone
+
+# Hash of the latest reading of every sensor, field = sensor_id, value = JSON reading
+LATEST_KEY = "sensors:latest"
+# Hash of the last_seen of those readings in epoch milliseconds, what the script compares
+LATEST_TIME_KEY = "sensors:latest:time"
+
+# Writes the reading only if it is not older than the stored one, so redelivered or
+# out-of-order messages never roll a sensor back
+SET_IF_NEWER = """
+local current = redis.call('HGET', KEYS[2], ARGV[1])
+if current and tonumber(current) > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+return 1
+"""
+
+
+def _epoch_ms(last_seen):
+    try:
+        timestamp = datetime.fromisoformat(last_seen)
+    except (TypeError, ValueError):
+        timestamp = datetime.now(timezone.utc)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+
+class LatestReadings:
+    """
+    Last-value projection of the readings, kept in two Redis hashes so the latest reading of
+    any number of sensors is read with a single HMGET or HGETALL.
+    """
+
+    def __init__(self, redis):
+        """
+        Args:
+            redis (RedisClient): The client the projection is stored with.
+        """
+        self.redis = redis
+        self._set_if_newer = redis.register_script(SET_IF_NEWER)
+
+    def set(self, sensor_id, reading):
+        """
+        Stores a reading unless a newer one of the sensor is already stored.
+
+        Args:
+            sensor_id (int): The ID of the sensor.
+            reading (dict): The velocity, temperature, humidity, battery_level and last_seen of the reading.
+
+        Returns:
+            bool: Whether the reading was stored.
+        """
+        return bool(self._set_if_newer(
+            keys=[LATEST_KEY, LATEST_TIME_KEY],
+            args=[str(sensor_id), json.dumps(reading), _epoch_ms(reading.get("last_seen"))]
+        ))
+
+    def get(self, sensor_ids=None):
+        """
+        Retrieves the latest readings.
+
+        Args:
+            sensor_ids (list, optional): The IDs of the sensors, all the sensors if not given.
+
+        Returns:
+            dict: The latest reading of each sensor ID that has one.
+        """
+        if sensor_ids is None:
+            values = {int(sensor_id): value for sensor_id, value in self.redis.hgetall(LATEST_KEY).items()}
+        elif not sensor_ids:
+            # HMGET needs at least one field
+            return {}
+        else:
+            values = dict(zip(sensor_ids, self.redis.hmget(LATEST_KEY, [str(sensor_id) for sensor_id in sensor_ids])))
+        return {sensor_id: json.loads(value) for sensor_id, value in values.items() if value is not None}
+
+    def delete(self, sensor_id):
+        self.redis.hdel(LATEST_KEY, str(sensor_id))
+        self.redis.hdel(LATEST_TIME_KEY, str(sensor_id))
@@ -13,7 +13,10 @@ class MessageStrcuture:
     
     def to_dict(self):
         return {"action": self.action, "data": self.data}
-    
+
+    def encode(self, codec):
+        return codec.encode(self.to_dict())
+
     def keys(self):
         return self.data.keys()
     
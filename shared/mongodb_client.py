@@ -20,6 +20,7 @@ class MongoDBClient:
         clearDb(database): Drops the specified database.
         insert_data(document): Inserts a document into the collection.
         get_data(sensor_id): Retrieves a document by sensor ID.
+        get_many(sensor_ids): Retrieves the documents of several sensor IDs.
         get_near_sensors(latitude, longitude, radius): Finds sensors near a given location.
     """
 
@@ -114,6 +115,22 @@ class MongoDBClient:
             print(f"Error getting data: {e}")
             return None
 
+    def get_many(self, sensor_ids):
+        """
+        Retrieves the documents of several sensor IDs with a single query.
+
+        Parameters:
+            sensor_ids (list): The IDs of the sensors to find.
+
+        Returns:
+            A list with the documents found, in no particular order.
+        """
+        try:
+            return list(self.collection.find({"id": {"$in": list(sensor_ids)}}))
+        except Exception as e:
+            print(f"Error getting data: {e}")
+            return []
+
     def get_near_sensors(self, latitude, longitude, radius):
         """
         Finds sensors near a given location within a specified radius.
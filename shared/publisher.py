@@ -2,50 +2,341 @@ import pika
 import logging
 import json
 import time
+import threading
+from concurrent.futures import Future, TimeoutError, wait
 from shared.message import MessageStrcuture
+from shared.codec import JsonCodec
+from shared import topology
+from shared.topology import READINGS_EXCHANGE
 logging.basicConfig(level=logging.INFO)
 
 QUEUE_NAME = 'test'
 
 class Publisher:
-    def __init__(self):
+    """
+    Thread-safe publisher. A pika SelectConnection runs on its own I/O thread, which also
+    answers the broker heartbeats and reopens the connection when the broker drops it.
+
+    Messages are buffered by `enqueue` and sent in bursts of `batch_size`, or whatever was
+    enqueued within `batch_latency` seconds of the first one, so concurrent callers share
+    a burst. With publisher confirms the burst is pipelined: every message is published
+    without waiting and the broker acks or nacks them by delivery tag afterwards.
+    """
+
+    def __init__(self, confirm_delivery=False, batch_size=1, batch_latency=0.0, codec=None, confirm_timeout=30):
+        """
+        Args:
+            confirm_delivery (bool, optional): Turns on publisher confirms, so the broker acks or nacks every message.
+            batch_size (int, optional): Number of buffered messages that are sent right away as one burst.
+            batch_latency (float, optional): Maximum seconds a buffered message waits for the burst to fill up.
+            codec (optional): Wire codec from `shared.codec` used for MessageStrcuture payloads. Defaults to JSON.
+            confirm_timeout (float, optional): Seconds `wait` and `flush` wait for the broker confirms.
+        """
         self.credentials = pika.PlainCredentials('guest', 'guest')
         self.parameters = pika.ConnectionParameters('rabbitmq', 5672, '/', self.credentials)
         self.conn = None
         self.channel = None
+        self.confirm_delivery = confirm_delivery
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.codec = codec or JsonCodec()
+        self.confirm_timeout = confirm_timeout
+        self._lock = threading.Lock()
+        # (exchange, routing_key, message, future) tuples not sent yet. Messages sent on a channel
+        # that closed before confirming them come back here and are sent again.
+        self._pending = []
+        # Sent messages waiting for their confirm, by delivery tag
+        self._unconfirmed = {}
+        # Delivery tags of the mandatory messages the broker returned as unroutable
+        self._returned = set()
+        self._delivery_tag = 0
+        self._declared = set()
+        self._declaring = False
+        self._timer = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._open_error = None
+        # Set once a channel was opened, from then on the I/O thread reconnects by itself
+        self._reconnect = False
+        self._closing = False
         self.connect()
 
     def connect(self):
         retries = 3
         for attempt in range(retries):
-            try:
-                logging.info(f"Attempting to connect to RabbitMQ (attempt {attempt + 1}/{retries})")
-                self.conn = pika.BlockingConnection(self.parameters)
-                self.channel = self.conn.channel()
-                self.channel.queue_declare(queue=QUEUE_NAME)
+            logging.info(f"Attempting to connect to RabbitMQ (attempt {attempt + 1}/{retries})")
+            self._ready.clear()
+            self._open_error = None
+            self.conn = self._open_connection()
+            self._thread = threading.Thread(target=self._run, name="publisher-io", daemon=True)
+            self._thread.start()
+            self._ready.wait()
+            if self._open_error is None:
                 logging.info("Successfully connected to RabbitMQ")
-                break
-            except pika.exceptions.AMQPConnectionError as e:
-                logging.error(f"Connection attempt {attempt + 1} failed: {e}")
-                if attempt < retries - 1:
-                    time.sleep(10)
-                else:
-                    logging.critical("All connection attempts failed")
-                    raise e
-                
-    def _declare_queue(self, queue_name):
+                return
+            self._thread.join()
+            logging.error(f"Connection attempt {attempt + 1} failed: {self._open_error}")
+            if attempt < retries - 1:
+                time.sleep(10)
+            else:
+                logging.critical("All connection attempts failed")
+                raise pika.exceptions.AMQPConnectionError(self._open_error)
+
+    def _open_connection(self):
+        return pika.SelectConnection(
+            self.parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed
+        )
+
+    def _run(self):
+        # Body of the I/O thread, every channel operation happens here
+        delay = 1
+        while True:
+            try:
+                self.conn.ioloop.start()
+            except Exception as e:
+                logging.error(f"RabbitMQ I/O loop failed: {e}")
+            if not self._reconnect and not self._ready.is_set():
+                self._open_error = self._open_error or "I/O loop stopped"
+                self._ready.set()
+            if self._closing or not self._reconnect:
+                return
+            logging.warning(f"Lost connection to RabbitMQ, reconnecting in {delay}s")
+            time.sleep(delay)
+            if self._closing:
+                return
+            delay = min(delay * 2, 30)
+            self.conn = self._open_connection()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        if not self._reconnect:
+            self._open_error = error
+            self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        self.channel = None
+        self._timer = None
+        self._declaring = False
+        self._returned.clear()
+        with self._lock:
+            # Nothing tells whether the broker got them, they are sent again on the next channel
+            self._pending[:0] = list(self._unconfirmed.values())
+            self._unconfirmed.clear()
+        if not self._reconnect:
+            self._open_error = reason
+            self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        self._delivery_tag = 0
+        self._declared = set()
+        channel.add_on_close_callback(self._on_channel_closed)
+        if self.confirm_delivery:
+            channel.add_on_return_callback(self._on_return)
+            channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=self._on_channel_ready)
+        else:
+            self._on_channel_ready(None)
+
+    def _on_channel_ready(self, frame):
+        self._reconnect = True
+        self._ready.set()
+        self._send_pending()
+
+    def _on_channel_closed(self, channel, reason):
+        # A channel closed by the broker is not reopened on its own, the connection is
+        logging.warning(f"RabbitMQ channel closed: {reason}")
+        self._close_connection()
+
+    def _on_return(self, channel, method, properties, body):
+        # A returned message is still acked by the broker, the ack then reports it as failed
+        try:
+            self._returned.add(int(properties.message_id))
+        except (TypeError, ValueError):
+            pass
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self._lock:
+            if method.multiple:
+                tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag] if method.delivery_tag in self._unconfirmed else []
+            confirmed = [(tag, self._unconfirmed.pop(tag)) for tag in tags]
+        for tag, (exchange, routing_key, message, future) in confirmed:
+            returned = tag in self._returned
+            self._returned.discard(tag)
+            if not acked or returned:
+                logging.error(f"Message to {exchange or routing_key} was {'returned' if returned else 'nacked'} by the broker")
+            if not future.done():
+                future.set_result(acked and not returned)
+
+    def _declare(self, targets):
+        # Channel RPCs are sent one after the other, the callback of the last one means every one is done
+        calls = [call for exchange, routing_key in targets for call in topology.operations(exchange, routing_key)]
+        for index, (method, kwargs) in enumerate(calls):
+            callback = (lambda frame: self._on_declared(targets)) if index == len(calls) - 1 else None
+            getattr(self.channel, method)(callback=callback, **kwargs)
+
+    def _on_declared(self, targets):
+        self._declared.update(targets)
+        self._declaring = False
+        self._send_pending()
+
+    def _encode(self, message, delivery_tag):
+        # The content type tells the subscriber which codec to decode the body with, the message id
+        # identifies a returned message
+        if isinstance(message, MessageStrcuture):
+            content_type = self.codec.content_type
+            body = message.encode(self.codec)
+        else:
+            # Other payloads (e.g. the example queue) keep the plain JSON format
+            content_type = JsonCodec.content_type
+            body = message.to_json()
+        return body, pika.BasicProperties(content_type=content_type, message_id=str(delivery_tag))
+
+    def _send_pending(self):
+        # Publishes the buffered messages as one burst, on the I/O thread
+        if self._timer is not None:
+            self.conn.ioloop.remove_timeout(self._timer)
+            self._timer = None
+        if self.channel is None or not self.channel.is_open or self._declaring:
+            return
+
+        with self._lock:
+            targets = {(exchange, routing_key) for exchange, routing_key, _, _ in self._pending} - self._declared
+            if targets:
+                self._declaring = True
+            else:
+                burst, self._pending = self._pending, []
+                sent = []
+                for entry in burst:
+                    self._delivery_tag += 1
+                    self._unconfirmed[self._delivery_tag] = entry
+                    sent.append((self._delivery_tag, entry))
+        if targets:
+            self._declare(targets)
+            return
+
+        try:
+            for delivery_tag, (exchange, routing_key, message, future) in sent:
+                body, properties = self._encode(message, delivery_tag)
+                self.channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties,
+                    mandatory=self.confirm_delivery
+                )
+                if not self.confirm_delivery:
+                    with self._lock:
+                        self._unconfirmed.pop(delivery_tag, None)
+                    future.set_result(True)
+        except pika.exceptions.AMQPError as e:
+            # The burst stays unconfirmed and is sent again once the connection is reopened
+            logging.error(f"Failed to publish a burst of {len(sent)} messages: {e}")
+
+    def _schedule(self):
+        # Sends the burst once the oldest buffered message waited batch_latency seconds
+        if self._timer is None:
+            self._timer = self.conn.ioloop.call_later(self.batch_latency, self._send_pending)
+
+    def _call(self, callback):
+        # Runs a callback on the I/O thread. Without a connection the buffered messages are
+        # sent once the I/O thread reopened it.
         try:
-            # Check if the queue exists
-            self.channel.queue_declare(queue=queue_name)
-        except pika.exceptions.ChannelClosedByBroker:
-            # Queue does not exist, create it
-            self.channel = self.connection.channel()  # Re-open the channel
-            self.channel.queue_declare(queue=queue_name)
-            logging.info(f"Queue '{queue_name}' created")
-            
+            self.conn.ioloop.add_callback_threadsafe(callback)
+        except Exception as e:
+            logging.warning(f"RabbitMQ I/O loop is not running: {e}")
+
+    def _close_connection(self):
+        if not (self.conn.is_closing or self.conn.is_closed):
+            self.conn.close()
+
+    def is_healthy(self):
+        """
+        Checks that the connection and the channel are open.
+        """
+        return self.conn is not None and self.conn.is_open and self.channel is not None and self.channel.is_open
+
+    def enqueue(self, routing_key, message: MessageStrcuture, exchange=''):
+        """
+        Buffers a message. The buffer is sent once it holds `batch_size` messages or its oldest
+        message waited `batch_latency` seconds.
+
+        Args:
+            routing_key (str): The queue the message is sent to, ignored by fan-out exchanges.
+            message (MessageStrcuture): The message to publish.
+            exchange (str, optional): The exchange to publish to. Defaults to the default exchange.
+
+        Returns:
+            Future: Resolves to True once the broker acked the message, or False if it nacked or
+                returned it. Without `confirm_delivery` it resolves to True once the message is sent.
+        """
+        future = Future()
+        with self._lock:
+            self._pending.append((exchange, routing_key, message, future))
+            size = len(self._pending)
+        if size >= self.batch_size or self.batch_latency <= 0:
+            self._call(self._send_pending)
+        elif size == 1:
+            self._call(self._schedule)
+        return future
+
+    def wait(self, future, timeout=None):
+        """
+        Waits for a message returned by `enqueue` to be confirmed.
+
+        Returns:
+            bool: Whether the broker confirmed the message within `timeout` seconds (`confirm_timeout` by default).
+        """
+        try:
+            return future.result(timeout=timeout or self.confirm_timeout)
+        except TimeoutError:
+            logging.error(f"Message was not confirmed within {timeout or self.confirm_timeout}s")
+            return False
+
+    def flush(self, timeout=None):
+        """
+        Sends every buffered message now and waits for the confirms of the burst.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the confirms, `confirm_timeout` by default.
+
+        Returns:
+            list: The (routing_key, message) pairs nacked or returned by the broker, or not confirmed
+                in time, so the caller can retry them.
+
+        Note:
+            - The messages leave the buffer only when they are sent. A burst sent on a connection
+              that drops before its confirms is sent again once the connection is reopened.
+        """
+        with self._lock:
+            entries = self._pending + list(self._unconfirmed.values())
+        if not entries:
+            return []
+        self._call(self._send_pending)
+        wait([future for _, _, _, future in entries], timeout=timeout or self.confirm_timeout)
+
+        nacked = [(routing_key, message) for _, routing_key, message, future in entries
+                  if not (future.done() and future.result())]
+        logging.info(f" [x] Flushed {len(entries) - len(nacked)}/{len(entries)} messages")
+        return nacked
+
+    def _publish(self, exchange, routing_key, message):
+        if not self.wait(self.enqueue(routing_key, message, exchange=exchange)):
+            raise pika.exceptions.AMQPError(f"Message to {exchange or routing_key} was not confirmed")
+
     def publish(self, message: MessageStrcuture):
         try:
-            self.channel.basic_publish(exchange='', routing_key=QUEUE_NAME, body=message.to_json())
+            self._publish('', QUEUE_NAME, message)
             logging.info(f" [x] Sent {message}")
         except Exception as e:
             logging.error(f"Failed to publish message: {e}")
@@ -53,12 +344,7 @@ class Publisher:
         
     def publish_to(self, routing_key, message: MessageStrcuture):
         try:
-            self._declare_queue(routing_key)
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=routing_key,
-                body=message.to_json()
-            )
+            self._publish('', routing_key, message)
             logging.info(f" [x] Sent {message} to {routing_key}")
         except Exception as e:
             logging.error(f"Failed to publish message to {routing_key}: {e}")
@@ -66,9 +352,52 @@ class Publisher:
 
     def close(self):
         if self.conn:
-            self.conn.close()
+            self.flush()
+            self._closing = True
+            self._call(self._close_connection)
+            self._thread.join()
+            with self._lock:
+                abandoned, self._pending = self._pending + list(self._unconfirmed.values()), []
+                self._unconfirmed.clear()
+            for _, _, _, future in abandoned:
+                if not future.done():
+                    future.set_result(False)
             logging.info("Connection to RabbitMQ closed")
 
+class PublisherPool:
+    """
+    Hands the threads of the API threadpool the process-wide Publisher, created lazily on
+    first use. The Publisher is thread-safe, so the readings of concurrent requests share
+    its bursts and their confirms.
+    """
+
+    def __init__(self, **publisher_kwargs):
+        """
+        Args:
+            publisher_kwargs: Keyword arguments the Publisher is created with.
+        """
+        self._publisher_kwargs = publisher_kwargs
+        self._lock = threading.Lock()
+        self._publisher = None
+
+    def get(self) -> Publisher:
+        """
+        Returns the shared publisher, connecting it on first use.
+        """
+        with self._lock:
+            if self._publisher is None:
+                self._publisher = Publisher(**self._publisher_kwargs)
+            return self._publisher
+
+    def close(self):
+        with self._lock:
+            publisher, self._publisher = self._publisher, None
+        if publisher is not None:
+            try:
+                publisher.close()
+            except Exception as e:
+                logging.error(f"Failed to close publisher: {e}")
+
 if __name__ == "__main__":
     publisher = Publisher()
     message = {'key': 'value'}
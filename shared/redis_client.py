@@ -19,8 +19,26 @@ class RedisClient:
     def set(self, key, value):
         return self._client.set(key, value)
     
-    def delete(self, key):
-        return self._client.delete(key)
+    def delete(self, *keys):
+        return self._client.delete(*keys)
+
+    def hmget(self, key, fields):
+        return self._client.hmget(key, fields)
+
+    def hset(self, key, mapping):
+        return self._client.hset(key, mapping=mapping)
+
+    def hgetall(self, key):
+        return self._client.hgetall(key)
+
+    def hdel(self, key, *fields):
+        return self._client.hdel(key, *fields)
+
+    def register_script(self, script):
+        return self._client.register_script(script)
+
+    def expire(self, key, seconds):
+        return self._client.expire(key, seconds)
     
     def keys(self, pattern):
         return self._client.keys(pattern)
@@ -2,6 +2,7 @@ from fastapi import HTTPException
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from shared.mongodb_client import MongoDBClient
@@ -10,9 +11,14 @@ from shared.sensors import models, schemas
 from shared.cassandra_client import CassandraClient
 from shared.elasticsearch_client import ElasticsearchClient
 from shared.timescale import Timescale
+from shared.bucket_cache import BucketCache
+from shared.latest_readings import LatestReadings
 from shared.message import MessageStrcuture
-from shared.publisher import Publisher
+from shared.publisher import Publisher, READINGS_EXCHANGE
+from shared.async_publisher import AsyncPublisher
 import json
+import logging
+from datetime import datetime
 
 def get_sensor(db: Session, mongodb: MongoDBClient, sensor_id: int) -> Optional[models.Sensor]:
     db_sensor = db.query(models.Sensor).filter(
@@ -143,6 +149,32 @@ def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb: MongoDBCli
     return output
 
 
+def reading_message(sensor_id: int, sensor_type: str, data: schemas.SensorData) -> MessageStrcuture:
+    """
+    Builds the canonical reading message published to the readings exchange.
+
+    Parameters:
+        sensor_id (int): The ID of the sensor that sent the reading.
+        sensor_type (str): The type of the sensor, needed by the Cassandra projections.
+        data (schemas.SensorData): The reading.
+
+    Returns:
+        MessageStrcuture: A message with the "reading" action.
+    """
+    return MessageStrcuture(
+        action_type="reading",
+        data={
+            "sensor_id": sensor_id,
+            "sensor_type": sensor_type,
+            "velocity": data.velocity,
+            "temperature": data.temperature,
+            "humidity": data.humidity,
+            "battery_level": data.battery_level,
+            "last_seen": data.last_seen
+        }
+    )
+
+
 def record_data(db: Session, mongo_db: MongoDBClient, sensor_id: int, data: schemas.SensorData, publisher: Publisher) -> schemas.Sensor:
     """
     Updates sensor data in SQL database, Redis, and MongoDB, then returns the updated sensor information.
@@ -166,97 +198,52 @@ def record_data(db: Session, mongo_db: MongoDBClient, sensor_id: int, data: sche
         raise HTTPException(
             status_code=404, detail="Sensor not found in SQL database")
 
-    # Convert sensor data to JSON string for Redis
-    # Using .dict() method if data is a Pydantic model
-    dyn_data = json.dumps(data.dict())
-    # Update sensor data in Redis
-    #redis.set(str(sensor_id), dyn_data)  # Ensure the key is a string
-    meesage = MessageStrcuture(
-        action_type="set_data",
-        data={
-            "sensor_id": sensor_id,
-            "data": data.dict()
-        }
-    )
-
-    publisher.publish_to("redis", meesage)
-
     # Check if the sensor exists in MongoDB
     document = mongo_db.get_data(sensor_id)
     if document is None:
         raise HTTPException(
             status_code=404, detail="Sensor not found in MongoDB")
 
-    # Assuming you might want to update the sensor data in MongoDB as well, but it's missing here.
-    # mongo_db.update_data(sensor_id, data_dict) # Hypothetical method to update sensor data in MongoDB.
+    # Publish the reading once to the fan-out exchange, every sink (Redis, Timescale, Cassandra)
+    # consumes it from its own bound queue and keeps the fields it needs
+    # The reading shares a burst with the concurrent requests, only its own confirm is awaited
+    confirmed = publisher.enqueue("", reading_message(sensor_id, db_sensor['type'], data), exchange=READINGS_EXCHANGE)
+    if not publisher.wait(confirmed):
+        raise HTTPException(
+            status_code=503, detail="Broker did not confirm the reading, retry the request")
 
-    # Deserialize dynamic data back into a Python dictionary for further processing
-    try:
-        data_dict = json.loads(dyn_data)
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=400, detail=f"Error parsing data: {e}")
+    return data.dict()
 
-    # Insert sensor data into TimescaleDB
-    """
-    ts_db.insert_data(sensor_id,
-                      velocity=data.velocity,
-                      temperature=data.temperature,
-                      humidity=data.humidity,
-                      battery_level=data.battery_level,
-                      last_seen=data.last_seen)
-    """
-
-    meesage = MessageStrcuture(
-        action_type="insert_data",
-        data={
-            "sensor_id": sensor_id,
-            "velocity": data.velocity if hasattr(data, 'velocity') else None,
-            "temperature": data.temperature if hasattr(data, 'temperature') else None,
-            "humidity": data.humidity,
-            "battery_level": data.battery_level,
-            "last_seen": data.last_seen
-        }
-    )
-
-    publisher.publish_to("ts", meesage)
 
+async def record_data_async(db: Session, mongo_db: MongoDBClient, sensor_id: int, data: schemas.SensorData, publisher: AsyncPublisher) -> schemas.Sensor:
     """
-    cassandra.insert_data(sensor_id,
-                          last_seen=data.last_seen,
-                          sensor_type=db_sensor['type'],
-                          temperature=data.temperature,
-                          velocity=data.velocity)
+    Same as record_data, but awaits the publish on the event loop instead of blocking a threadpool thread.
 
-    cassandra.insert_battery_level(sensor_id, data.battery_level)
-    """
+    Parameters:
+        db (Session): Database session for SQL operations.
+        mongo_db (MongoDBClient): Client for MongoDB operations.
+        sensor_id (int): The ID of the sensor to update.
+        data (schemas.SensorData): The new data for the sensor.
+        publisher (AsyncPublisher): The asyncio publisher.
 
-    message = MessageStrcuture(
-        action_type="insert_data",
-        data={
-            "sensor_id": sensor_id,
-            "last_seen": data.last_seen,
-            "sensor_type": db_sensor['type'],
-            "temperature": data.temperature,
-            "velocity": data.velocity
-        }
-    )
+    Returns:
+        schemas.Sensor: The recorded sensor data.
 
-    publisher.publish_to("cassandra", message)
+    Raises:
+        HTTPException: If the sensor is not found or the broker does not confirm the reading.
+    """
+    # The SQL and MongoDB clients are blocking, so only the sensor lookup goes to the threadpool
+    db_sensor = await run_in_threadpool(get_sensor, db, mongo_db, sensor_id)
 
-    message = MessageStrcuture(
-        action_type="insert_battery_level",
-        data={
-            "sensor_id": sensor_id,
-            "battery_level": data.battery_level
-        }
-    )
-    
-    publisher.publish_to("cassandra", message)
+    confirmed = await publisher.publish("", reading_message(sensor_id, db_sensor['type'], data), exchange=READINGS_EXCHANGE)
+    if not confirmed:
+        raise HTTPException(
+            status_code=503, detail="Broker rejected the reading, retry the request")
 
-    return data_dict
+    return data.dict()
 
 
-def get_data(db: Session, mongo_db: MongoDBClient, timescale: Timescale, sensor_id: int, from_date: str, to_date: str, bucket_size: str) -> schemas.Sensor:
+def get_data(db: Session, mongo_db: MongoDBClient, timescale: Timescale, sensor_id: int, from_date: str, to_date: str, bucket_size: str, cache: Optional[BucketCache] = None, max_points: Optional[int] = None, method: str = "lttb") -> schemas.Sensor:
     """
     Retrieves sensor data from SQL database, Redis, and MongoDB, and returns a consolidated sensor object.
 
@@ -265,6 +252,9 @@ def get_data(db: Session, mongo_db: MongoDBClient, timescale: Timescale, sensor_
         redis (RedisClient): The client for Redis operations.
         mongo_db (MongoDBClient): The client for MongoDB operations.
         sensor_id (int): The ID of the sensor to retrieve data for.
+        cache (BucketCache, optional): Serves the finalised buckets instead of Timescale.
+        max_points (int, optional): Downsample the buckets to at most this many points.
+        method (str): The downsampling method, 'lttb' or 'min_max'.
 
     Returns:
         schemas.Sensor: The consolidated sensor object with data from all sources.
@@ -284,12 +274,122 @@ def get_data(db: Session, mongo_db: MongoDBClient, timescale: Timescale, sensor_
         raise HTTPException(
             status_code=404, detail="Sensor not found in MongoDB")
 
+    if cache is not None:
+        return cache.get_data(timescale, sensor_id, from_date=from_date, to_date=to_date, bucket_size=bucket_size,
+                              max_points=max_points, method=method)
+
     timescale_data = timescale.get_data(
-        sensor_id, from_date=from_date, to_date=to_date, bucket_size=bucket_size)
+        sensor_id, from_date=from_date, to_date=to_date, bucket_size=bucket_size,
+        max_points=max_points, method=method)
     return timescale_data
 
 
-def delete_sensor(db: Session, mongo_db: MongoDBClient, redis: RedisClient, sensor_id: int):
+def get_data_many(db: Session, mongo_db: MongoDBClient, timescale: Timescale, sensor_ids: List[int], from_date: str, to_date: str, bucket_size: str, max_points: Optional[int] = None, method: str = "lttb") -> dict:
+    """
+    Retrieves the buckets of several sensors, validating them and querying Timescale once for all of them.
+
+    Parameters:
+        db (Session): The SQLAlchemy session for SQL database operations.
+        mongo_db (MongoDBClient): The client for MongoDB operations.
+        timescale (Timescale): The client for Timescale operations.
+        sensor_ids (List[int]): The IDs of the sensors to retrieve data for.
+        max_points (int, optional): Downsample the buckets of each sensor to at most this many points.
+        method (str): The downsampling method, 'lttb' or 'min_max'.
+
+    Returns:
+        dict: The buckets of each sensor, keyed by sensor ID.
+
+    Raises:
+        HTTPException: If any of the sensors is not found in the SQL database or MongoDB.
+    """
+    found = {sensor.id for sensor in db.query(models.Sensor.id).filter(
+        models.Sensor.id.in_(sensor_ids))}
+    missing = [sensor_id for sensor_id in sensor_ids if sensor_id not in found]
+    if missing:
+        raise HTTPException(
+            status_code=404, detail=f"Sensor not found in SQL database: {missing}")
+
+    found = {document["id"] for document in mongo_db.get_many(sensor_ids)}
+    missing = [sensor_id for sensor_id in sensor_ids if sensor_id not in found]
+    if missing:
+        raise HTTPException(
+            status_code=404, detail=f"Sensor not found in MongoDB: {missing}")
+
+    return timescale.get_data_many(
+        sensor_ids, from_date=from_date, to_date=to_date, bucket_size=bucket_size,
+        max_points=max_points, method=method)
+
+
+def get_readings(db: Session, mongo_db: MongoDBClient, cassandra: CassandraClient, sensor_id: int, from_date: datetime, to_date: datetime) -> list:
+    """
+    Retrieves the raw readings of a sensor from its Cassandra day partitions.
+
+    Parameters:
+        db (Session): The SQLAlchemy session for SQL database operations.
+        mongo_db (MongoDBClient): The client for MongoDB operations.
+        cassandra (CassandraClient): The client for Cassandra operations.
+        sensor_id (int): The ID of the sensor to retrieve the readings of.
+        from_date (datetime): The first timestamp, inclusive.
+        to_date (datetime): The last timestamp, inclusive.
+
+    Returns:
+        list: The readings, newest first.
+
+    Raises:
+        HTTPException: If the sensor is not found in the SQL database or MongoDB.
+    """
+    db_sensor = get_sensor(db, mongo_db, sensor_id)
+    if db_sensor is None:
+        raise HTTPException(
+            status_code=404, detail="Sensor not found in SQL database")
+
+    if mongo_db.get_data(sensor_id) is None:
+        raise HTTPException(
+            status_code=404, detail="Sensor not found in MongoDB")
+
+    return cassandra.get_data_range(sensor_id, from_date, to_date)
+
+
+def get_latest(redis: RedisClient, sensor_ids: Optional[List[int]] = None) -> dict:
+    """
+    Retrieves the latest reading of several sensors with a single Redis round trip.
+
+    Parameters:
+        redis (RedisClient): The client for Redis operations.
+        sensor_ids (List[int], optional): The IDs of the sensors, every sensor if not given.
+
+    Returns:
+        dict: The latest reading of each sensor, keyed by sensor ID. Sensors without readings are left out.
+    """
+    return LatestReadings(redis).get(sensor_ids)
+
+
+def stream_data(db: Session, mongo_db: MongoDBClient, timescale: Timescale, sensor_id: int, from_date: str, to_date: str, bucket_size: str):
+    """
+    Streams the buckets of get_data as NDJSON, one JSON array per line.
+
+    Parameters:
+        db (Session): The SQLAlchemy session for SQL database operations.
+        mongo_db (MongoDBClient): The client for MongoDB operations.
+        timescale (Timescale): The client for Timescale operations, it must stay open while the response is streamed.
+        sensor_id (int): The ID of the sensor to retrieve data for.
+
+    Returns:
+        generator: The lines of the response body.
+
+    Raises:
+        HTTPException: If the sensor is not found in the SQL database or MongoDB.
+    """
+    # Validate the sensor before the response starts, errors can not be reported once it is streaming
+    get_sensor(db, mongo_db, sensor_id)
+
+    rows = timescale.iter_data(
+        sensor_id, from_date=from_date, to_date=to_date, bucket_size=bucket_size)
+    for bucket, temperature, humidity, battery_level, velocity in rows:
+        yield json.dumps([bucket.isoformat(), temperature, humidity, battery_level, velocity]) + "\n"
+
+
+def delete_sensor(db: Session, mongo_db: MongoDBClient, redis: RedisClient, sensor_id: int, publisher: Optional[Publisher] = None):
     """
     Deletes a sensor from the SQL database, MongoDB, and Redis by its ID.
 
@@ -298,6 +398,8 @@ def delete_sensor(db: Session, mongo_db: MongoDBClient, redis: RedisClient, sens
         mongo_db (MongoDBClient): The client for MongoDB operations.
         redis (RedisClient): The client for Redis operations.
         sensor_id (int): The ID of the sensor to be deleted.
+        publisher (Publisher, optional): Publishes the delete to the Cassandra consumer, which drops
+            the sensor's data and uncounts it from /sensors/quantity_by_type.
 
     Returns:
         The sensor object from the SQL database that was deleted.
@@ -317,6 +419,9 @@ def delete_sensor(db: Session, mongo_db: MongoDBClient, redis: RedisClient, sens
     db.delete(db_sensor)
     db.commit()
 
+    # The type is only stored in MongoDB, read it before the document is deleted
+    document = mongo_db.get_data(sensor_id)
+
     # Delete the sensor data from MongoDB
     # Assuming mongo_db.delete_data is correctly implemented to handle deletion by sensor_id
     mongo_db.delete_data(sensor_id)
@@ -324,6 +429,22 @@ def delete_sensor(db: Session, mongo_db: MongoDBClient, redis: RedisClient, sens
     # Delete the sensor data from Redis
     # The key used here should match how sensor data is stored/retrieved in Redis
     redis.delete(str(sensor_id))  # Ensure sensor_id is a string for Redis keys
+    BucketCache(redis).invalidate(sensor_id)
+    LatestReadings(redis).delete(sensor_id)
+
+    if publisher is not None:
+        message = MessageStrcuture(
+            action_type="delete",
+            data={
+                "sensor_id": sensor_id,
+                "sensor_type": document.get("type") if document else None
+            }
+        )
+        # The sensor is already deleted, a lost message only leaves drift the reconcile job repairs
+        try:
+            publisher.publish_to("cassandra", message)
+        except Exception as e:
+            logging.error(f"Failed to publish the delete of sensor {sensor_id}: {e}")
 
     # Return the deleted sensor object from the SQL database
     return db_sensor
@@ -488,12 +609,12 @@ def get_sensors_quantity(cassandra: CassandraClient):
     return output
 
 
-def get_low_battery_sensors(db: Session, cassandra: CassandraClient, mongodb: MongoDBClient):
+def get_low_battery_sensors(db: Session, cassandra: CassandraClient, mongodb: MongoDBClient, threshold: float = 0.2):
     output = {
         "sensors": [],
     }
 
-    low_battery_sensors = cassandra.get_sensor_low_battery()
+    low_battery_sensors = cassandra.get_sensor_low_battery(threshold)
 
     for row in low_battery_sensors:
         sensor_id = row.get('sensor_id')
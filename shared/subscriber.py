@@ -2,15 +2,38 @@ import pika
 import logging
 import time
 from threading import Thread
+from shared import topology
+from shared.codec import get_codec
 
 class Subscriber:
+    # Sink exceptions that mean the connection is broken, subclasses list the ones of their driver
+    connection_errors = ()
+
     def __init__(self, config):
         self.queue_name = config['queue_name']
+        # Fan-out exchanges whose messages are also delivered to this queue
+        self.exchanges = config.get('exchanges', [])
+        # At most prefetch_count unacked messages are pushed to this consumer, so memory stays
+        # bounded while a backlog drains
+        self.prefetch_count = config.get('prefetch_count', 100)
+        # Messages are handed to the sink in batches of batch_size, or whatever arrived within
+        # batch_interval_ms of the first one, and the batch is acked once the sink wrote it
+        self.batch_size = config.get('batch_size', 1)
+        self.batch_interval = config.get('batch_interval_ms', 200) / 1000
         print(f"Queue name: {self.queue_name}")
         self.credentials = pika.PlainCredentials(config['rabbitmq']['username'], config['rabbitmq']['password'])
         self.parameters = pika.ConnectionParameters(config['rabbitmq']['host'], config['rabbitmq']['port'], '/', self.credentials)
         self.conn = None
         self.channel = None
+        self._batch = []
+        self._batch_timer = None
+        # Long-lived connection to the database the messages are written to, see get_sink
+        self.sink = None
+        self.sink_retries = config.get('sink_retries', 5)
+        # Failed messages wait in a TTL queue per tier before they are dead-lettered back to the
+        # queue, once every tier is used up they are parked for inspection (see consumer/parked.py)
+        self.retry_delays = config.get('retry_delays_ms', [1000, 10000, 60000])
+        self.parking_queue = f"{self.queue_name}.parked"
         self.connect()
 
     def connect(self):
@@ -20,7 +43,11 @@ class Subscriber:
                 logging.info(f"Attempting to connect to RabbitMQ (attempt {attempt + 1}/{retries})")
                 self.conn = pika.BlockingConnection(self.parameters)
                 self.channel = self.conn.channel()
-                self.channel.queue_declare(queue=self.queue_name)
+                self.channel.basic_qos(prefetch_count=self.prefetch_count)
+                topology.declare(self.channel, routing_key=self.queue_name)
+                for exchange in self.exchanges:
+                    topology.declare(self.channel, exchange, self.queue_name)
+                self._declare_retry_queues()
                 logging.info(f"Successfully connected to RabbitMQ, queue name: {self.queue_name}")
                 break
             except pika.exceptions.AMQPConnectionError as e:
@@ -31,19 +58,204 @@ class Subscriber:
                     logging.critical("All connection attempts failed")
                     raise e
 
-    def consume(self):
-        def callback(ch, method, properties, body):
-            logging.info(f"Received message: {body}")
+    def _retry_queue(self, tier):
+        return f"{self.queue_name}.retry.{tier}"
+
+    def _declare_retry_queues(self):
+        for tier, delay in enumerate(self.retry_delays, start=1):
+            self.channel.queue_declare(queue=self._retry_queue(tier), arguments={
+                'x-message-ttl': delay,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': self.queue_name,
+            })
+        self.channel.queue_declare(queue=self.parking_queue)
+
+    def decode(self, properties, body):
+        # Publishers announce their codec through the content type, messages without one are JSON
+        return get_codec(properties.content_type).decode(body)
+
+    def connect_sink(self):
+        """
+        Opens the connection to the database the messages are written to. Subclasses
+        return their client, which must have a `close` method.
+        """
+        return None
+
+    def get_sink(self, retries=1):
+        """
+        Returns the sink client, connecting it on first use or after a failure.
+
+        Args:
+            retries (int, optional): Connection attempts, backing off exponentially (1s, 2s, 4s...).
+                Only the startup connection retries, at runtime a failed message goes to the
+                retry queues instead of blocking the consumer.
+
+        Raises:
+            Exception: The last connection error if every attempt failed.
+        """
+        delay = 1
+        for attempt in range(retries):
+            if self.sink is not None:
+                break
+            try:
+                self.sink = self.connect_sink()
+                break
+            except Exception as e:
+                logging.error(f"Sink connection attempt {attempt + 1}/{retries} failed: {e}")
+                if attempt == retries - 1:
+                    raise e
+                time.sleep(delay)
+                delay *= 2
+        return self.sink
+
+    def is_connection_error(self, error):
+        """
+        Tells whether a sink error means the connection is broken. Only then the sink is
+        reconnected, data errors go to the retry queues and the connection is kept.
+
+        Args:
+            error (Exception): The error raised while writing to the sink.
+        """
+        return isinstance(error, self.connection_errors)
+
+    def close_sink(self):
+        if self.sink is not None:
+            try:
+                self.sink.close()
+            except Exception as e:
+                logging.error(f"Failed to close sink connection: {e}")
+            self.sink = None
+
+    def handle(self, action, data):
+        """
+        Writes one message to the sink. Subclasses override it, raising an exception
+        means the message was not processed.
+
+        Args:
+            action (str): The action of the message.
+            data (dict): The data of the message.
+        """
+        logging.info(f"Received message of action: {action}, data: {data}")
 
+    def handle_batch(self, messages):
+        """
+        Writes a batch of messages to the sink. The default implementation calls `handle`
+        for every message, sinks that can write a batch at once override it.
+
+        Args:
+            messages (list): (action, data) tuples in delivery order.
+        """
+        for action, data in messages:
+            self.handle(action, data)
+
+    def _on_message(self, ch, method, properties, body):
+        try:
+            message = self.decode(properties, body)
+        except Exception as e:
+            # A message that cannot be decoded will never succeed, park it straight away
+            logging.error(f"Parking undecodable message {method.delivery_tag}: {e}")
+            self._retry(properties, body, e, park=True)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        self._batch.append((method.delivery_tag, message.get("action"), message.get("data"), properties, body))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._batch_timer is None:
+            self._batch_timer = self.conn.call_later(self.batch_interval, self._on_batch_timer)
+
+    def _on_batch_timer(self):
+        self._batch_timer = None
+        self.flush()
+
+    def flush(self):
+        """
+        Writes the pending batch to the sink and settles it with a single ack.
+
+        If the batch fails, its messages are written one by one so a single poison message
+        does not hold the others back, and the ones that still fail are sent to the retry queues.
+        """
+        if self._batch_timer is not None:
+            self.conn.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        # multiple=True settles every outstanding delivery up to the last one of the batch
+        last_delivery_tag = batch[-1][0]
         try:
-            self.channel.basic_consume(queue=self.queue_name, on_message_callback=callback, auto_ack=True)
-            logging.info("Started consuming messages")
+            self.handle_batch([(action, data) for _, action, data, _, _ in batch])
+        except Exception as e:
+            logging.error(f"Failed to process a batch of {len(batch)} messages: {e}")
+            # A broken connection is reopened before the messages are written one by one
+            if self.is_connection_error(e):
+                self.close_sink()
+            self._process_one_by_one(batch)
+        self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+    def _process_one_by_one(self, batch):
+        for index, (delivery_tag, action, data, properties, body) in enumerate(batch):
+            try:
+                self.get_sink()
+            except Exception as e:
+                # The sink is down, send the rest of the batch to the retry queues instead of failing each message
+                for _, _, _, pending_properties, pending_body in batch[index:]:
+                    self._retry(pending_properties, pending_body, e)
+                return
+            try:
+                self.handle_batch([(action, data)])
+            except Exception as e:
+                logging.error(f"Failed to process message {delivery_tag}: {e}")
+                if self.is_connection_error(e):
+                    self.close_sink()
+                self._retry(properties, body, e)
+
+    def _retry(self, properties, body, error, park=False):
+        """
+        Republishes a failed message to the next retry tier, or to the parking queue once
+        every tier was used or if `park` is set. The caller acks the original delivery afterwards.
+        """
+        headers = dict(properties.headers or {})
+        attempt = headers.get('x-retry-count', 0) + 1
+        headers['x-retry-count'] = attempt
+        headers['x-last-error'] = str(error)[:512]
+
+        if attempt <= len(self.retry_delays) and not park:
+            routing_key = self._retry_queue(attempt)
+        else:
+            routing_key = self.parking_queue
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(content_type=properties.content_type, headers=headers)
+        )
+        logging.warning(f"Message sent to {routing_key} after {attempt} failed attempts")
+
+    def consume(self):
+        try:
+            # Connect to the sink once up front, it is reused for every message
+            self.get_sink(retries=self.sink_retries)
+            self.channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message)
+            logging.info(f"Started consuming messages from {self.queue_name}")
             self.channel.start_consuming()
         except Exception as e:
             logging.error(f"Error during consumption: {e}")
             raise e
 
+    def stop(self):
+        """
+        Stops consuming. Safe to call from a signal handler, consume() returns once the
+        I/O loop picks the request up.
+        """
+        if self.conn and self.conn.is_open:
+            self.conn.add_callback_threadsafe(self.channel.stop_consuming)
+
     def close(self):
         if self.conn:
+            if self.conn.is_open:
+                self.flush()
             self.conn.close()
+            self.close_sink()
             logging.info("Connection to RabbitMQ closed")
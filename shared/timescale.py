@@ -1,16 +1,218 @@
 import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
+import csv
+import io
 import os
-from datetime import datetime
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+from shared.downsampling import downsample
+
+# Continuous aggregates created by migrations_ts, keyed by the bucket sizes they can answer.
+# Each entry is the coarsest rollup whose buckets tile the requested bucket.
+ROLLUPS = {
+    "hour": ("sensor_data_hourly", timedelta(hours=1)),
+    "day": ("sensor_data_daily", timedelta(days=1)),
+    "week": ("sensor_data_daily", timedelta(days=1)),
+    "month": ("sensor_data_daily", timedelta(days=1)),
+}
+
+# End offsets of the refresh policies of the rollups in migrations_ts. A rollup is never materialized
+# closer to now than that, so newer rows are always merged from the raw hypertable in real time.
+ROLLUP_END_OFFSETS = {
+    "sensor_data_hourly": timedelta(hours=1),
+    "sensor_data_daily": timedelta(days=1),
+}
+
+# Retention of the raw hypertable, see migrations_ts. The rollup buckets of dropped chunks must not be refreshed.
+RETENTION_DAYS = int(os.environ.get("TS_RETENTION_DAYS", 365))
+
+# Rollups found in the database, checked once per process
+_available_rollups = set()
+
+
+def _parse_timestamp(value):
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def _floor(timestamp, step):
+    timestamp = timestamp.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if step >= timedelta(days=1):
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def _connect():
+    return psycopg2.connect(
+        host=os.environ.get("TS_HOST"),
+        port=os.environ.get("TS_PORT"),
+        user=os.environ.get("TS_USER"),
+        password=os.environ.get("TS_PASSWORD"),
+        database=os.environ.get("TS_DBNAME"))
+
+
+class TimescalePool:
+    """
+    Thread-safe pool of TimescaleDB connections, shared by the whole process through `get_pool`.
+
+    Checkouts wait up to `timeout` seconds when every connection is in use. Connections are
+    health checked on checkout and replaced once they are older than `max_lifetime` seconds.
+    """
+
+    def __init__(self, minconn=None, maxconn=None, max_lifetime=None, timeout=None, ping_after=30):
+        """
+        Args:
+            minconn (int, optional): Connections opened up front. Defaults to TS_POOL_MIN or 1.
+            maxconn (int, optional): Maximum open connections. Defaults to TS_POOL_MAX or 10.
+            max_lifetime (float, optional): Seconds after which a connection is replaced. Defaults to TS_POOL_MAX_LIFETIME or 1800.
+            timeout (float, optional): Seconds a checkout waits for a free connection. Defaults to TS_POOL_TIMEOUT or 30.
+            ping_after (float, optional): Connections idle for longer than this are pinged before being handed out.
+        """
+        self.minconn = minconn or int(os.environ.get("TS_POOL_MIN", 1))
+        self.maxconn = maxconn or int(os.environ.get("TS_POOL_MAX", 10))
+        self.max_lifetime = max_lifetime or float(os.environ.get("TS_POOL_MAX_LIFETIME", 1800))
+        self.timeout = timeout or float(os.environ.get("TS_POOL_TIMEOUT", 30))
+        self.ping_after = ping_after
+        self._cond = threading.Condition()
+        # Idle connections as (connection, created_at, last_used_at), most recently used last
+        self._idle = []
+        self._created_at = {}
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        for _ in range(self.minconn):
+            self._idle.append(self._open())
+
+    def _open(self):
+        conn = _connect()
+        now = time.monotonic()
+        self._created_at[id(conn)] = now
+        return conn, now, now
+
+    def _discard(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _healthy(self, conn, created_at, last_used_at):
+        now = time.monotonic()
+        if conn.closed or now - created_at > self.max_lifetime:
+            return False
+        if now - last_used_at > self.ping_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self):
+        """
+        Borrows a connection, it must be given back with `putconn`.
+
+        Raises:
+            PoolError: If no connection was released within `timeout` seconds.
+        """
+        start = time.monotonic()
+        with self._cond:
+            while not self._idle and self._in_use + len(self._idle) >= self.maxconn:
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise PoolError(f"No Timescale connection available after {self.timeout}s")
+                self._cond.wait(remaining)
+            idle = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self._waits += 1
+                self._wait_time += waited
+
+        try:
+            if idle is not None and self._healthy(*idle):
+                return idle[0]
+            if idle is not None:
+                self._discard(idle[0])
+            return self._open()[0]
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn):
+        """Gives a borrowed connection back to the pool."""
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+
+        with self._cond:
+            self._in_use -= 1
+            created_at = self._created_at.get(id(conn))
+            if conn.closed or created_at is None or time.monotonic() - created_at > self.max_lifetime:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The connections in use and idle, the maximum size, how many checkouts had to
+                wait and their total and average wait time in seconds.
+        """
+        with self._cond:
+            return {
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "max": self.maxconn,
+                "waits": self._waits,
+                "wait_time": self._wait_time,
+                "avg_wait_time": self._wait_time / self._waits if self._waits else 0.0,
+            }
+
+    def close(self):
+        """Closes the idle connections. The pool stays usable and reconnects on demand."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the process-wide TimescalePool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = TimescalePool()
+        return _pool
 
 
 class Timescale:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.environ.get("TS_HOST"),
-            port=os.environ.get("TS_PORT"),
-            user=os.environ.get("TS_USER"),
-            password=os.environ.get("TS_PASSWORD"),
-            database=os.environ.get("TS_DBNAME"))
+    def __init__(self, pool=None):
+        """
+        Args:
+            pool (TimescalePool, optional): Borrow the connection from this pool instead of opening
+                a dedicated one. `close` then gives it back to the pool.
+        """
+        self.pool = pool
+        self.conn = pool.getconn() if pool else _connect()
         self.cursor = self.conn.cursor()
         
         
@@ -19,7 +221,10 @@ class Timescale:
 
     def close(self):
         self.cursor.close()
-        self.conn.close()
+        if self.pool:
+            self.pool.putconn(self.conn)
+        else:
+            self.conn.close()
     
     def ping(self):
         return self.conn.ping()
@@ -52,8 +257,202 @@ class Timescale:
         )
         self.conn.commit()
 
+    def insert_many(self, readings):
+        """
+        Inserts several readings with a single multi-row INSERT and commits once.
+
+        Args:
+            readings (list): Dicts with the sensor_id, velocity, temperature, humidity, battery_level
+                and last_seen keys, as accepted by `insert_data`.
+
+        Note:
+            - Either every reading is stored or, if the insert fails, none of them.
+            - Readings already stored for the same (time, sensor_id) are skipped, so a redelivered
+              batch is a no-op instead of a unique violation.
+        """
+        rows = [
+            (reading.get("sensor_id"), reading.get("temperature"), reading.get("humidity"),
+             reading.get("battery_level"), reading.get("velocity"), reading.get("last_seen"))
+            for reading in readings
+        ]
+        try:
+            execute_values(
+                self.cursor,
+                "INSERT INTO sensor_data (sensor_id, temperature, humidity, battery_level, velocity, time) VALUES %s "
+                "ON CONFLICT (time, sensor_id) DO NOTHING",
+                rows,
+                page_size=len(rows) or 1
+            )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def copy_readings(self, readings, chunk_size=10000):
+        """
+        Streams readings into sensor_data with COPY FROM STDIN. The CSV buffer is built
+        incrementally, one chunk of `chunk_size` rows at a time, so `readings` can be a
+        generator of any length.
+
+        Every chunk is copied into a temporary staging table and moved to sensor_data with
+        INSERT ... ON CONFLICT DO NOTHING, so readings that are already stored are skipped
+        instead of aborting the COPY.
+
+        Args:
+            readings (iterable): Dicts with the sensor_id, velocity, temperature, humidity, battery_level
+                and last_seen keys, as accepted by `insert_data`.
+            chunk_size (int, optional): The number of rows copied and committed at once.
+
+        Returns:
+            list: One dict per chunk with the number of rows copied ('rows'), how many of them were new
+                ('inserted') and the seconds it took ('seconds').
+
+        Note:
+            - Every chunk is committed on its own, if a chunk fails the previous ones stay stored
+              and the whole backfill can simply be run again.
+            - The rollup buckets covering the copied readings are refreshed once all of them are stored,
+              see `refresh_rollups`.
+        """
+        # Session-scoped and emptied on every commit, a pooled connection reuses it
+        self.cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS sensor_data_staging (LIKE sensor_data INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        self.conn.commit()
+        readings = iter(readings)
+        stats = []
+        first = last = None
+        while True:
+            chunk = list(islice(readings, chunk_size))
+            if not chunk:
+                break
+
+            start = time.perf_counter()
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for reading in chunk:
+                try:
+                    timestamp = _parse_timestamp(reading.get("last_seen"))
+                    first = timestamp if first is None else min(first, timestamp)
+                    last = timestamp if last is None else max(last, timestamp)
+                except (TypeError, ValueError):
+                    pass
+                # None is written as an empty unquoted field, which COPY reads as NULL
+                writer.writerow((reading.get("sensor_id"), reading.get("temperature"), reading.get("humidity"),
+                                 reading.get("battery_level"), reading.get("velocity"), reading.get("last_seen")))
+            buffer.seek(0)
+
+            try:
+                self.cursor.copy_expert(
+                    "COPY sensor_data_staging (sensor_id, temperature, humidity, battery_level, velocity, time) FROM STDIN WITH (FORMAT csv)",
+                    buffer
+                )
+                self.cursor.execute(
+                    "INSERT INTO sensor_data (sensor_id, temperature, humidity, battery_level, velocity, time) "
+                    "SELECT sensor_id, temperature, humidity, battery_level, velocity, time FROM sensor_data_staging "
+                    "ON CONFLICT (time, sensor_id) DO NOTHING"
+                )
+                inserted = self.cursor.rowcount
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            stats.append({"rows": len(chunk), "inserted": inserted, "seconds": time.perf_counter() - start})
+
+        if first is not None:
+            self.refresh_rollups((first, last))
+        return stats
+
+    def refresh_rollups(self, times):
+        """
+        Refreshes the rollup buckets that rows written or deleted late can have changed.
+
+        With materialized_only = false a rollup only merges the rows above its watermark in real
+        time. Rows written or deleted below it stay invisible to `get_data` until their buckets
+        are refreshed, and the refresh policies only pick up invalidated buckets on their next run.
+
+        Args:
+            times (iterable): The timestamps of the rows, as datetimes or ISO 8601 strings.
+
+        Returns:
+            list: The (view, start, end) windows that were refreshed.
+
+        Note:
+            - Only rows older than the end offset of a rollup's refresh policy can be below its
+              watermark, so writes of current readings never trigger a refresh.
+            - Like the refresh policies, it never refreshes further back than TS_RETENTION_DAYS - 1 days,
+              a bucket whose raw chunks were dropped would lose its aggregated rows.
+            - Commits the current transaction, refresh_continuous_aggregate cannot run inside one.
+        """
+        timestamps = []
+        for timestamp in times:
+            try:
+                timestamps.append(timestamp if isinstance(timestamp, datetime) else _parse_timestamp(timestamp))
+            except (TypeError, ValueError):
+                continue
+
+        now = datetime.now(timezone.utc)
+        if RETENTION_DAYS > 0:
+            retained_after = now - timedelta(days=RETENTION_DAYS - 1)
+            timestamps = [timestamp for timestamp in timestamps if timestamp >= retained_after]
+        steps = dict(ROLLUPS.values())
+        windows = []
+        for view, end_offset in ROLLUP_END_OFFSETS.items():
+            step = steps[view]
+            # Buckets ending after this one are never materialized by the policy
+            materialized_before = _floor(now - end_offset, step)
+            late = [timestamp for timestamp in timestamps if timestamp < materialized_before]
+            if late and self._has_rollup(view):
+                windows.append((view, _floor(min(late), step), _floor(max(late), step) + step))
+        if not windows:
+            return []
+
+        self.conn.commit()
+        self.conn.autocommit = True
+        try:
+            for view, start, end in windows:
+                self.cursor.execute("CALL refresh_continuous_aggregate(%s, %s, %s)", (view, start, end))
+        finally:
+            self.conn.autocommit = False
+        return windows
+
+    def _has_rollup(self, view):
+        if view not in _available_rollups:
+            self.cursor.execute("SELECT to_regclass(%s)", (view,))
+            if self.cursor.fetchone()[0] is None:
+                return False
+            _available_rollups.add(view)
+        return True
+
+    def _rollup_for(self, bucket_size, from_date, to_date):
+        """
+        Picks the continuous aggregate that can answer a query.
+
+        Returns:
+            tuple: (view, tail_start) where the rollup answers [from_date, tail_start) and the raw
+                hypertable the remaining [tail_start, to_date], or None to query the raw hypertable only.
 
-    def get_data(self, sensor_id, from_date, to_date, bucket_size):
+        Note:
+            - The rollup matches the raw hypertable only once the buckets changed below its watermark
+              are refreshed. The write paths of this class and TimeScaleConsumer do so through
+              `refresh_rollups`, rows changed by any other writer show up after the policy's next run.
+        """
+        if bucket_size not in ROLLUPS or from_date is None or to_date is None:
+            return None
+        view, step = ROLLUPS[bucket_size]
+        try:
+            start = _parse_timestamp(from_date)
+            end = _parse_timestamp(to_date)
+        except (TypeError, ValueError):
+            return None
+        # A range that starts inside a rollup bucket would pick up rows before from_date
+        if _floor(start, step) != start:
+            return None
+        tail_start = _floor(end, step)
+        if tail_start < start or not self._has_rollup(view):
+            return None
+        return view, tail_start
+
+    def get_data(self, sensor_id, from_date, to_date, bucket_size, max_points=None, method="lttb"):
         """
         Retrieves sensor data for a specified time range and bucket size.
 
@@ -62,6 +461,8 @@ class Timescale:
             from_date (str): The start date and time in the format 'YYYY-MM-DDTHH:MM:SS.000Z'.
             to_date (str): The end date and time in the format 'YYYY-MM-DDTHH:MM:SS.000Z'.
             bucket_size (str): The size of time buckets for aggregation. Can be 'hour', 'day', 'week', or 'month'.
+            max_points (int, optional): Downsample the buckets to at most this many, see `shared.downsampling`.
+            method (str, optional): The downsampling method, 'lttb' or 'min_max'.
 
         Returns:
             list: A list of tuples containing aggregated sensor data for each time bucket.
@@ -69,13 +470,92 @@ class Timescale:
 
         Note:
             - 'day' indicates that the aggregation is done by day.
+            - When the hourly/daily continuous aggregates exist and from_date is aligned to them, the
+              buckets are merged from the rollup and only the last partial rollup bucket is read
+              from the raw hypertable. Late rows are only included once `refresh_rollups` ran over them.
+        """
+        query, params = self._data_query(sensor_id, from_date, to_date, bucket_size)
+        self.cursor.execute(query, params)
+        return downsample(self.cursor.fetchall(), max_points, method)
+
+    def iter_data(self, sensor_id, from_date, to_date, bucket_size, itersize=2000):
+        """
+        Same as `get_data`, but yields the rows from a server-side cursor that fetches
+        `itersize` rows at a time, so memory stays flat whatever the size of the range.
+
+        Note:
+            - The connection must stay open until the generator is exhausted or closed.
+        """
+        query, params = self._data_query(sensor_id, from_date, to_date, bucket_size)
+        cursor = self.conn.cursor(name=f"sensor_data_{uuid.uuid4().hex}")
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+            self.conn.rollback()
+
+    def get_data_many(self, sensor_ids, from_date, to_date, bucket_size, max_points=None, method="lttb"):
         """
+        Retrieves the buckets of several sensors with a single grouped query.
+
+        Args:
+            sensor_ids (list): The IDs of the sensors.
+            from_date (str): The start date and time in the format 'YYYY-MM-DDTHH:MM:SS.000Z'.
+            to_date (str): The end date and time in the format 'YYYY-MM-DDTHH:MM:SS.000Z'.
+            bucket_size (str): The size of time buckets for aggregation. Can be 'hour', 'day', 'week', or 'month'.
+            max_points (int, optional): Downsample the buckets of each sensor to at most this many.
+            method (str, optional): The downsampling method, 'lttb' or 'min_max'.
+
+        Returns:
+            dict: The `get_data` tuples of each sensor ID, sensors without data map to an empty list.
+        """
+        query, params = self._data_query(list(sensor_ids), from_date, to_date, bucket_size, many=True)
+        self.cursor.execute(query, params)
+        data = {sensor_id: [] for sensor_id in sensor_ids}
+        for row in self.cursor.fetchall():
+            data[row[0]].append(row[1:])
+        return {sensor_id: downsample(rows, max_points, method) for sensor_id, rows in data.items()}
+
+    def _data_query(self, sensor_id, from_date, to_date, bucket_size, many=False):
+        # Query and parameters shared by get_data, iter_data and, with many=True and a list
+        # of sensor IDs, get_data_many, which also returns and groups by the sensor_id
+        rollup = self._rollup_for(bucket_size, from_date, to_date)
         bucket_size = f"1 {bucket_size}"
-        self.cursor.execute(
-            "SELECT time_bucket(%s, time) AS bucket, AVG(temperature) AS temperature, AVG(humidity) AS humidity, AVG(battery_level) AS battery_level, AVG(velocity) AS velocity FROM sensor_data WHERE sensor_id = %s AND time >= %s AND time <= %s GROUP BY bucket ORDER BY bucket ASC",
-            (bucket_size, sensor_id, from_date, to_date)
+        sensor_filter = "sensor_id = ANY(%s)" if many else "sensor_id = %s"
+        sensor_column = "sensor_id, " if many else ""
+
+        if rollup is None:
+            return (
+                f"SELECT {sensor_column}time_bucket(%s, time) AS bucket, AVG(temperature) AS temperature, AVG(humidity) AS humidity, AVG(battery_level) AS battery_level, AVG(velocity) AS velocity FROM sensor_data WHERE {sensor_filter} AND time >= %s AND time <= %s GROUP BY {sensor_column}bucket ORDER BY {sensor_column}bucket ASC",
+                (bucket_size, sensor_id, from_date, to_date)
+            )
+
+        view, tail_start = rollup
+        return (
+            f"""
+            SELECT {sensor_column}time_bucket(%s, time) AS bucket,
+                   SUM(temperature_sum) / NULLIF(SUM(temperature_count), 0) AS temperature,
+                   SUM(humidity_sum) / NULLIF(SUM(humidity_count), 0) AS humidity,
+                   SUM(battery_level_sum) / NULLIF(SUM(battery_level_count), 0) AS battery_level,
+                   SUM(velocity_sum) / NULLIF(SUM(velocity_count), 0) AS velocity
+            FROM (
+                SELECT sensor_id, bucket AS time, temperature_sum, temperature_count, humidity_sum, humidity_count,
+                       battery_level_sum, battery_level_count, velocity_sum, velocity_count
+                FROM {view}
+                WHERE {sensor_filter} AND bucket >= %s AND bucket < %s
+                UNION ALL
+                SELECT sensor_id, time, temperature, (temperature IS NOT NULL)::int, humidity, (humidity IS NOT NULL)::int,
+                       battery_level, (battery_level IS NOT NULL)::int, velocity, (velocity IS NOT NULL)::int
+                FROM sensor_data
+                WHERE {sensor_filter} AND time >= %s AND time <= %s
+            ) AS merged
+            GROUP BY {sensor_column}bucket ORDER BY {sensor_column}bucket ASC
+            """,
+            (bucket_size, sensor_id, from_date, tail_start, sensor_id, tail_start, to_date)
         )
-        return self.cursor.fetchall()
     
     def delete_sensor_data(self, sensor_id):
         """
@@ -84,5 +564,10 @@ class Timescale:
         Args:
             sensor_id (str): The ID of the sensor.
         """
+        self.cursor.execute("SELECT MIN(time), MAX(time) FROM sensor_data WHERE sensor_id = %s", (sensor_id,))
+        first, last = self.cursor.fetchone()
         self.cursor.execute("DELETE FROM sensor_data WHERE sensor_id = %s", (sensor_id,))
-        self.conn.commit()
\ No newline at end of file
+        self.conn.commit()
+        # The materialized buckets of the sensor would otherwise outlive its rows
+        if first is not None:
+            self.refresh_rollups((first, last))
\ No newline at end of file
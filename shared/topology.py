@@ -0,0 +1,88 @@
+"""
+RabbitMQ topology shared by the publishers and the subscribers.
+
+Readings are published once to a fan-out exchange and every sink consumes them from its
+own bound queue. Whoever connects first declares the exchange together with the sink
+queues and their bindings, so readings published before the consumers are up wait in the
+queues instead of being dropped as unroutable.
+"""
+
+READINGS_EXCHANGE = 'sensor_readings'
+
+# Sink queues bound to every fan-out exchange, they match the "exchanges" of consumer/config*.json
+BINDINGS = {
+    READINGS_EXCHANGE: ('redis', 'ts', 'cassandra'),
+}
+
+
+def queues(exchange='', routing_key=''):
+    """
+    Returns the queues a message sent to `exchange` with `routing_key` is delivered to.
+
+    Args:
+        exchange (str, optional): The exchange, empty for the default exchange.
+        routing_key (str, optional): The queue of the default exchange, or an extra queue to bind.
+
+    Returns:
+        list: The queue names, in declaration order.
+    """
+    names = list(BINDINGS.get(exchange, ()))
+    if routing_key and routing_key not in names:
+        names.append(routing_key)
+    return names
+
+
+def operations(exchange='', routing_key=''):
+    """
+    Lists the pika channel calls that declare the exchange, its queues and their bindings.
+
+    Args:
+        exchange (str, optional): The exchange, empty for the default exchange.
+        routing_key (str, optional): The queue of the default exchange, or an extra queue to bind.
+
+    Returns:
+        list: (method name, keyword arguments) tuples, valid for blocking and async pika channels.
+    """
+    calls = []
+    if exchange:
+        calls.append(('exchange_declare', {'exchange': exchange, 'exchange_type': 'fanout'}))
+    for queue in queues(exchange, routing_key):
+        calls.append(('queue_declare', {'queue': queue}))
+        if exchange:
+            calls.append(('queue_bind', {'queue': queue, 'exchange': exchange}))
+    return calls
+
+
+def declare(channel, exchange='', routing_key=''):
+    """
+    Declares the topology on a pika BlockingChannel.
+
+    Args:
+        channel (pika.adapters.blocking_connection.BlockingChannel): The channel.
+        exchange (str, optional): The exchange, empty for the default exchange.
+        routing_key (str, optional): The queue of the default exchange, or an extra queue to bind.
+    """
+    for method, kwargs in operations(exchange, routing_key):
+        getattr(channel, method)(**kwargs)
+
+
+async def declare_async(channel, exchange='', routing_key=''):
+    """
+    Declares the topology on an aio-pika channel.
+
+    Args:
+        channel (aio_pika.abc.AbstractChannel): The channel.
+        exchange (str, optional): The exchange, empty for the default exchange.
+        routing_key (str, optional): The queue of the default exchange, or an extra queue to bind.
+
+    Returns:
+        aio_pika.abc.AbstractExchange: The exchange to publish to.
+    """
+    target = channel.default_exchange
+    if exchange:
+        target = await channel.declare_exchange(exchange, 'fanout')
+    for name in queues(exchange, routing_key):
+        queue = await channel.declare_queue(name)
+        if exchange:
+            await queue.bind(target)
+    return target